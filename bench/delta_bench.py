@@ -0,0 +1,88 @@
+"""
+Microbenchmark of delta extraction over synthetic cumulative upstream events.
+
+    python -m bench.delta_bench --tokens 8000 --rounds 5
+"""
+import argparse
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from session.delta import StreamDelta  # noqa: E402
+
+
+def synthetic_events(tokens):
+    # upstream sends the whole answer so far on every event
+    words = ["tok{} ".format(i % 97) for i in range(tokens)]
+    text = ""
+    events = []
+    for word in words:
+        text += word
+        events.append(text)
+    return events
+
+
+def baseline(events):
+    # the previous implementation: prefix slice plus string concatenation
+    res = ""
+    prev_text = ""
+    for text in events:
+        message = text[len(prev_text):]
+        res += message
+        prev_text = text
+    return res
+
+
+def prefix_checked(events):
+    # rewrite detection done naively, comparing the whole emitted prefix
+    res = ""
+    prev_text = ""
+    rewrites = 0
+    for text in events:
+        if not text.startswith(prev_text):
+            rewrites += 1
+        message = text[len(prev_text):]
+        res += message
+        prev_text = text
+    return res
+
+
+def stream_delta(events):
+    delta = StreamDelta()
+    for text in events:
+        delta.feed(text)
+    return delta.text
+
+
+def measure(fn, events, rounds):
+    best = float("inf")
+    result = None
+    for _ in range(rounds):
+        start = time.perf_counter()
+        result = fn(events)
+        best = min(best, time.perf_counter() - start)
+    return best, result
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--tokens", type=int, default=8000)
+    parser.add_argument("--rounds", type=int, default=5)
+    args = parser.parse_args()
+
+    events = synthetic_events(args.tokens)
+    base_time, base_result = measure(baseline, events, args.rounds)
+    checked_time, checked_result = measure(prefix_checked, events, args.rounds)
+    delta_time, delta_result = measure(stream_delta, events, args.rounds)
+    assert base_result == checked_result == delta_result
+
+    print("tokens: {}, answer chars: {}".format(args.tokens, len(events[-1])))
+    print("baseline:     {:8.2f} ms".format(base_time * 1000))
+    print("prefix check: {:8.2f} ms".format(checked_time * 1000))
+    print("stream delta: {:8.2f} ms".format(delta_time * 1000))
+
+
+if __name__ == "__main__":
+    main()
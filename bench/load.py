@@ -0,0 +1,367 @@
+"""
+Load test of the engine against the local mock upstream, no real account is used.
+
+    python -m bench.load --concurrency 1,8,32 --requests 200 --stream
+    python -m bench.load --replay ../requests.jsonl --concurrency 8 --output run.json
+
+The mock upstream and an engine with ``--accounts`` fake accounts are
+started as child processes unless ``--upstream-url`` or ``--engine-url`` point
+at running ones. For every concurrency level it reports throughput, time to
+first token, p50/p99 latency, errors, engine cpu per request and resident
+memory growth.
+
+Replay files have one json object per line; ``sentence`` (or ``body``,
+``title``), ``user_id`` (or ``request_id``), ``model`` and ``stream`` are
+read when present. Lines carrying ``at``, seconds since the start of the
+recording, are sent at those offsets divided by ``--speed`` instead of at a
+fixed concurrency.
+"""
+import argparse
+import asyncio
+import itertools
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import time
+
+import httpx
+import yaml
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from session.hedge import percentile  # noqa: E402
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+CLOCK_TICKS = os.sysconf("SC_CLK_TCK") if hasattr(os, "sysconf") else 100
+PAGE_SIZE = os.sysconf("SC_PAGE_SIZE") if hasattr(os, "sysconf") else 4096
+
+
+def process_tree(pid):
+    """pid and its children, the workers and coordinator of a multi worker engine."""
+    pids = [pid]
+    try:
+        for entry in os.listdir("/proc"):
+            if entry.isdigit():
+                with open("/proc/{}/stat".format(entry)) as f:
+                    fields = f.read().rsplit(")", 1)[1].split()
+                if int(fields[1]) == pid:
+                    pids.append(int(entry))
+    except OSError:
+        pass
+    return pids
+
+
+def cpu_seconds(pid):
+    total = 0
+    for p in process_tree(pid):
+        try:
+            with open("/proc/{}/stat".format(p)) as f:
+                fields = f.read().rsplit(")", 1)[1].split()
+            total += int(fields[11]) + int(fields[12])
+        except OSError:
+            return None
+    return total / CLOCK_TICKS
+
+
+def rss_bytes(pid):
+    total = 0
+    for p in process_tree(pid):
+        try:
+            with open("/proc/{}/statm".format(p)) as f:
+                total += int(f.read().split()[1]) * PAGE_SIZE
+        except OSError:
+            return None
+    return total
+
+
+def load_replay(path, stream):
+    items = []
+    with open(path, encoding="utf-8") as f:
+        for line in f:
+            if not line.strip():
+                continue
+            record = json.loads(line)
+            items.append({
+                "sentence": record.get("sentence") or record.get("body") or record.get("title") or "",
+                "user_id": str(record.get("user_id") or record.get("request_id") or len(items)),
+                "model": record.get("model") or "text-davinci-002-render-sha",
+                "stream": record.get("stream", stream),
+                "at": record.get("at"),
+            })
+    return items
+
+
+def synthetic(args):
+    for i in itertools.count():
+        yield {
+            "sentence": "benchmark prompt {}".format(i),
+            # new users start new conversations, repeated ones continue theirs
+            "user_id": "bench-{}".format(i % args.users) if args.users else None,
+            "model": args.model,
+            "stream": args.stream,
+            "at": None,
+        }
+
+
+async def send(client: httpx.AsyncClient, engine_url, item):
+    """Return (latency, ttft, error) of one request."""
+    start = time.perf_counter()
+    ttft = None
+    if item["stream"]:
+        body = {"sentence": item["sentence"], "user_id": item["user_id"], "model": item["model"]}
+        error = None
+        async with client.stream("POST", engine_url + "/chat-stream", json=body) as response:
+            if response.status_code != 200:
+                await response.aread()
+                return time.perf_counter() - start, None, str(response.status_code)
+            async for line in response.aiter_lines():
+                if line.startswith('data: {"message"'):
+                    event = json.loads(line[len("data: "):])
+                    if "retry_after" in event:
+                        # turned away by admission after the stream started
+                        error = str(event["code"])
+                    elif ttft is None:
+                        ttft = time.perf_counter() - start
+                if line.startswith("data: [DONE]"):
+                    break
+            else:
+                error = "unfinished"
+        return time.perf_counter() - start, ttft, error
+    params = {"sentence": item["sentence"], "model": item["model"]}
+    if item["user_id"] is not None:
+        params["user_id"] = item["user_id"]
+    response = await client.get(engine_url + "/chat", params=params)
+    latency = time.perf_counter() - start
+    body = response.json() if response.status_code == 200 else {}
+    if response.status_code != 200 or "detail" in body:
+        return latency, None, str(body.get("code", response.status_code))
+    return latency, latency, None
+
+
+async def run_level(engine_url, items, concurrency, engine_pid, speed):
+    results = []
+    timeout = httpx.Timeout(300, connect=10)
+    limits = httpx.Limits(max_connections=concurrency + 16, max_keepalive_connections=concurrency + 16)
+    async with httpx.AsyncClient(timeout=timeout, limits=limits) as client:
+
+        async def one(item):
+            try:
+                results.append(await send(client, engine_url, item))
+            except httpx.HTTPError as e:
+                results.append((None, None, type(e).__name__))
+
+        cpu_before = cpu_seconds(engine_pid) if engine_pid else None
+        rss_before = rss_bytes(engine_pid) if engine_pid else None
+        start = time.perf_counter()
+        if all(item["at"] is not None for item in items):
+            # open loop, requests are sent when they were recorded
+            origin = min(item["at"] for item in items)
+            tasks = []
+            for item in sorted(items, key=lambda i: i["at"]):
+                delay = (item["at"] - origin) / speed - (time.perf_counter() - start)
+                if delay > 0:
+                    await asyncio.sleep(delay)
+                tasks.append(asyncio.create_task(one(item)))
+            await asyncio.gather(*tasks)
+        else:
+            queue = iter(items)
+
+            async def worker():
+                for item in queue:
+                    await one(item)
+
+            await asyncio.gather(*[worker() for _ in range(concurrency)])
+        elapsed = time.perf_counter() - start
+        cpu_after = cpu_seconds(engine_pid) if engine_pid else None
+        rss_after = rss_bytes(engine_pid) if engine_pid else None
+
+    latencies = [r[0] for r in results if r[2] is None]
+    ttfts = [r[1] for r in results if r[2] is None and r[1] is not None]
+    errors = {}
+    for r in results:
+        if r[2] is not None:
+            errors[r[2]] = errors.get(r[2], 0) + 1
+    report = {
+        "concurrency": concurrency,
+        "requests": len(results),
+        "ok": len(latencies),
+        "errors": errors,
+        "seconds": elapsed,
+        "throughput": len(latencies) / elapsed if elapsed else 0,
+        "ttft_p50": percentile(ttfts, 0.5),
+        "ttft_p99": percentile(ttfts, 0.99),
+        "latency_p50": percentile(latencies, 0.5),
+        "latency_p99": percentile(latencies, 0.99),
+        "cpu_ms_per_request": None,
+        "rss_growth_mb": None,
+    }
+    if cpu_before is not None and cpu_after is not None and results:
+        report["cpu_ms_per_request"] = (cpu_after - cpu_before) * 1000 / len(results)
+    if rss_before is not None and rss_after is not None:
+        report["rss_growth_mb"] = (rss_after - rss_before) / 2 ** 20
+    return report
+
+
+def start_upstream(args):
+    command = [
+        sys.executable, "-m", "bench.mock_upstream",
+        "--port", str(args.upstream_port),
+        "--ttft", str(args.ttft),
+        "--token-rate", str(args.token_rate),
+        "--tokens", str(args.tokens),
+        "--rate-limit", str(args.rate_limit),
+        "--server-error", str(args.server_error),
+    ]
+    return subprocess.Popen(command, cwd=ROOT)
+
+
+def start_engine(args, upstream_url, directory):
+    config = {
+        "engine": {
+            "port": args.engine_port,
+            "workers": args.workers,
+            "server": {"mode": "production", "drainDelay": 0},
+            "chatgpt": {
+                "concurrency": args.account_concurrency,
+                "tokens": [
+                    "bench{}@example.com:password:bench-access-token-{}".format(i, i)
+                    for i in range(args.accounts)
+                ],
+                "minReady": args.accounts,
+            },
+        },
+    }
+    if args.engine_config:
+        with open(args.engine_config, encoding="utf-8") as f:
+            extra = yaml.safe_load(f) or {}
+        for key, value in (extra.get("engine") or {}).items():
+            if key == "chatgpt":
+                config["engine"]["chatgpt"].update({k: v for k, v in value.items() if k != "tokens"})
+            elif key not in ("port", "workers"):
+                config["engine"][key] = value
+    path = os.path.join(directory, "config.yaml")
+    with open(path, "w", encoding="utf-8") as f:
+        yaml.safe_dump(config, f)
+    env = dict(os.environ)
+    env["CHATGPT_BASE_URL"] = upstream_url + "/api/"
+    env["OPENAI_MODELS_URL"] = upstream_url + "/models"
+    # the client library caches access tokens under the home directory
+    env["HOME"] = directory
+    env["BOT_ENGINE_CONFIG_PATH"] = path
+    log = open(os.path.join(directory, "engine.log"), "w")
+    return subprocess.Popen([sys.executable, "main.py"], cwd=ROOT, env=env, stdout=log, stderr=log)
+
+
+async def wait_ready(url, path, timeout=60):
+    deadline = time.monotonic() + timeout
+    async with httpx.AsyncClient() as client:
+        while time.monotonic() < deadline:
+            try:
+                response = await client.get(url + path)
+                if response.status_code == 200:
+                    return
+            except httpx.HTTPError:
+                pass
+            await asyncio.sleep(0.2)
+    raise Exception("{} not ready after {}s".format(url, timeout))
+
+
+def print_report(report):
+    def ms(value):
+        return "{:8.1f}".format(value * 1000) if value is not None else "       -"
+
+    print(
+        "{:>5} {:>6} {:>6} {:>9} {} {} {} {} {:>8} {:>8}  {}".format(
+            report["concurrency"],
+            report["requests"],
+            report["ok"],
+            "{:.1f}".format(report["throughput"]),
+            ms(report["ttft_p50"]),
+            ms(report["ttft_p99"]),
+            ms(report["latency_p50"]),
+            ms(report["latency_p99"]),
+            "{:.2f}".format(report["cpu_ms_per_request"]) if report["cpu_ms_per_request"] is not None else "-",
+            "{:.1f}".format(report["rss_growth_mb"]) if report["rss_growth_mb"] is not None else "-",
+            json.dumps(report["errors"]) if report["errors"] else "",
+        )
+    )
+
+
+async def run(args):
+    children = []
+    with tempfile.TemporaryDirectory() as directory:
+        try:
+            upstream_url = args.upstream_url
+            engine_url = args.engine_url
+            engine_pid = None
+            if engine_url is None:
+                if upstream_url is None:
+                    children.append(start_upstream(args))
+                    upstream_url = "http://127.0.0.1:{}".format(args.upstream_port)
+                    await wait_ready(upstream_url, "/stats")
+                engine = start_engine(args, upstream_url, directory)
+                children.append(engine)
+                engine_pid = engine.pid
+                engine_url = "http://127.0.0.1:{}".format(args.engine_port)
+                await wait_ready(engine_url, "/ready")
+
+            if args.replay:
+                items = load_replay(args.replay, args.stream)
+            else:
+                generator = synthetic(args)
+                items = None
+
+            print(
+                "{:>5} {:>6} {:>6} {:>9} {:>8} {:>8} {:>8} {:>8} {:>8} {:>8}  {}".format(
+                    "conc", "reqs", "ok", "req/s", "ttft50", "ttft99", "lat50", "lat99", "cpu ms", "rss MB", "errors"
+                )
+            )
+            reports = []
+            for concurrency in [int(c) for c in args.concurrency.split(",")]:
+                level_items = items if items is not None else list(itertools.islice(generator, args.requests))
+                report = await run_level(engine_url, level_items, concurrency, engine_pid, args.speed)
+                print_report(report)
+                reports.append(report)
+            if args.output:
+                with open(args.output, "w", encoding="utf-8") as f:
+                    json.dump({"args": vars(args), "reports": reports}, f, indent=2)
+        finally:
+            for child in reversed(children):
+                child.terminate()
+                try:
+                    child.wait(timeout=30)
+                except subprocess.TimeoutExpired:
+                    child.kill()
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--concurrency", default="1,8,32", help="comma separated levels")
+    parser.add_argument("--requests", type=int, default=200, help="requests per level")
+    parser.add_argument("--stream", action="store_true", help="use /chat-stream instead of /chat")
+    parser.add_argument("--model", default="text-davinci-002-render-sha")
+    parser.add_argument("--users", type=int, default=0, help="distinct user ids, 0 sends none")
+    parser.add_argument("--replay", help="jsonl file of recorded requests")
+    parser.add_argument("--speed", type=float, default=1.0, help="replay speed up of recorded offsets")
+    parser.add_argument("--output", help="write the reports as json")
+    parser.add_argument("--engine-url", help="use a running engine")
+    parser.add_argument("--engine-port", type=int, default=5998)
+    parser.add_argument("--engine-config", help="yaml whose engine section is merged into the config")
+    parser.add_argument("--workers", type=int, default=1)
+    parser.add_argument("--accounts", type=int, default=8)
+    parser.add_argument("--account-concurrency", type=int, default=4)
+    parser.add_argument("--upstream-url", help="use a running mock upstream")
+    parser.add_argument("--upstream-port", type=int, default=5999)
+    parser.add_argument("--ttft", type=float, default=0.5)
+    parser.add_argument("--token-rate", type=float, default=40)
+    parser.add_argument("--tokens", type=int, default=100)
+    parser.add_argument("--rate-limit", type=float, default=0.0)
+    parser.add_argument("--server-error", type=float, default=0.0)
+    args = parser.parse_args()
+    asyncio.run(run(args))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,69 @@
+"""
+Cost of the metrics recorded on the request path.
+
+    python -m bench.metrics_bench --calls 1000000
+"""
+import argparse
+import os
+import random
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from session.metrics import MetricsRegistry  # noqa: E402
+
+STAGES = ("admission", "slot", "connect", "ttft", "stream", "sse_encode", "sse_write")
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--calls", type=int, default=1000000)
+    parser.add_argument("--credentials", type=int, default=20)
+    args = parser.parse_args()
+
+    registry = MetricsRegistry()
+    stage_seconds = registry.histogram("stage_seconds", "", ("stage", "model", "credential"))
+    requests = registry.counter("requests_total", "", ("endpoint", "model", "result"))
+    emails = ["account{}@example.com".format(i) for i in range(args.credentials)]
+    labels = [
+        (stage, "text-davinci-002-render-sha", random.choice(emails))
+        for stage in STAGES
+        for _ in range(64)
+    ]
+    values = [random.expovariate(1) for _ in range(len(labels))]
+
+    start = time.perf_counter()
+    for i in range(args.calls):
+        j = i % len(labels)
+        stage_seconds.observe(labels[j], values[j])
+    observe = (time.perf_counter() - start) / args.calls
+
+    start = time.perf_counter()
+    for _ in range(args.calls):
+        requests.inc(("chat-stream", "text-davinci-002-render-sha", "ok"))
+    inc = (time.perf_counter() - start) / args.calls
+
+    start = time.perf_counter()
+    for i in range(args.calls):
+        j = i % len(labels)
+        time.monotonic() - values[j]
+    clock = (time.perf_counter() - start) / args.calls
+
+    start = time.perf_counter()
+    text = registry.render([registry.snapshot() for _ in range(4)])
+    render = time.perf_counter() - start
+
+    # every request records its stages, one counter and reads the clock per stage
+    per_request = len(STAGES) * (observe + clock) + inc
+    print("histogram observe: {:6.0f} ns".format(observe * 1e9))
+    print("counter inc:       {:6.0f} ns".format(inc * 1e9))
+    print("clock read:        {:6.0f} ns".format(clock * 1e9))
+    print("per request:       {:6.2f} us".format(per_request * 1e6))
+    print(
+        "render 4 workers:  {:6.2f} ms, {} lines".format(render * 1000, text.count("\n"))
+    )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,136 @@
+"""
+Local stand-in for the ChatGPT backend the engine talks to.
+
+    python -m bench.mock_upstream --port 5999 --ttft 0.5 --token-rate 40 --tokens 200
+
+Point the engine at it with CHATGPT_BASE_URL=http://127.0.0.1:5999/api/ and
+OPENAI_MODELS_URL=http://127.0.0.1:5999/models. Answers stream the whole
+text so far on every event like the real backend, and a share of requests
+can be failed with 429 or 5xx.
+"""
+import argparse
+import asyncio
+import json
+import random
+import uuid
+from dataclasses import dataclass, asdict
+
+from hypercorn.asyncio import serve
+from hypercorn.config import Config as HypercornConfig
+from quart import Quart, request
+
+app = Quart("mock_upstream")
+
+
+@dataclass
+class MockConfig:
+    ttft: float = 0.5
+    ttft_jitter: float = 0.2
+    token_rate: float = 40
+    tokens: int = 200
+    rate_limit: float = 0.0
+    server_error: float = 0.0
+
+
+@dataclass
+class MockStats:
+    requests: int = 0
+    rate_limited: int = 0
+    server_errors: int = 0
+    completed: int = 0
+    cancelled: int = 0
+
+
+mock_config = MockConfig()
+mock_stats = MockStats()
+
+
+def event(conversation_id, message_id, model, text, finished):
+    return "data: " + json.dumps({
+        "message": {
+            "id": message_id,
+            "author": {"role": "assistant"},
+            "content": {"content_type": "text", "parts": [text]},
+            "end_turn": finished,
+            "metadata": {
+                "model_slug": model,
+                "finish_details": {"type": "stop" if finished else None},
+            },
+        },
+        "conversation_id": conversation_id,
+        "error": None,
+    }) + "\n\n"
+
+
+@app.route('/api/conversation', methods=["POST"])
+async def conversation():
+    data = await request.get_json()
+    mock_stats.requests += 1
+    draw = random.random()
+    if draw < mock_config.rate_limit:
+        mock_stats.rate_limited += 1
+        return {"detail": "Too many requests in 1 hour. Try again later."}, 429
+    if draw < mock_config.rate_limit + mock_config.server_error:
+        mock_stats.server_errors += 1
+        return {"detail": "mock upstream error"}, random.choice((500, 502, 503))
+
+    conversation_id = data.get("conversation_id") or str(uuid.uuid4())
+    message_id = str(uuid.uuid4())
+    model = data.get("model")
+    interval = 1 / mock_config.token_rate if mock_config.token_rate > 0 else 0
+
+    async def events():
+        try:
+            await asyncio.sleep(max(random.gauss(mock_config.ttft, mock_config.ttft_jitter), 0))
+            text = ""
+            for i in range(mock_config.tokens):
+                text += "tok{} ".format(i)
+                yield event(conversation_id, message_id, model, text, i == mock_config.tokens - 1)
+                await asyncio.sleep(interval)
+            yield "data: [DONE]\n\n"
+            mock_stats.completed += 1
+        except asyncio.CancelledError:
+            mock_stats.cancelled += 1
+            raise
+
+    return events(), 200, {"Content-Type": "text/event-stream"}
+
+
+@app.route('/models')
+async def models():
+    # no _puid cookie, the client carries on without it
+    return {"detail": "not found"}, 404
+
+
+@app.route('/stats')
+async def stats():
+    return {"config": asdict(mock_config), "stats": asdict(mock_stats)}
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=5999)
+    parser.add_argument("--ttft", type=float, default=0.5, help="mean seconds to first token")
+    parser.add_argument("--ttft-jitter", type=float, default=0.2)
+    parser.add_argument("--token-rate", type=float, default=40, help="tokens per second")
+    parser.add_argument("--tokens", type=int, default=200, help="tokens per answer")
+    parser.add_argument("--rate-limit", type=float, default=0.0, help="share of requests failed with 429")
+    parser.add_argument("--server-error", type=float, default=0.0, help="share of requests failed with 5xx")
+    args = parser.parse_args()
+
+    mock_config.ttft = args.ttft
+    mock_config.ttft_jitter = args.ttft_jitter
+    mock_config.token_rate = args.token_rate
+    mock_config.tokens = args.tokens
+    mock_config.rate_limit = args.rate_limit
+    mock_config.server_error = args.server_error
+
+    hypercorn_config = HypercornConfig()
+    hypercorn_config.bind = ["{}:{}".format(args.host, args.port)]
+    hypercorn_config.accesslog = None
+    asyncio.run(serve(app, hypercorn_config))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,135 @@
+"""
+Write throughput of the sqlite session persistence at a given session churn.
+
+    python -m bench.persistence_bench --users 20000 --rate 2000 --seconds 5
+
+``rate`` is session updates per second, a streamed answer updates its session
+on every upstream event, so it is well above the request rate.
+"""
+import argparse
+import asyncio
+import os
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from session.persistence import SessionPersistence  # noqa: E402
+from session.user_session import UserSession  # noqa: E402
+
+MODEL = "text-davinci-002-render-sha"
+
+
+def make_sessions(users):
+    return [
+        UserSession(user_id=str(i), conversation_id="conversation-{}".format(i))
+        for i in range(users)
+    ]
+
+
+async def bulk(path, sessions):
+    # how fast a backlog of changed sessions is written
+    persistence = SessionPersistence(path=path, batch_size=len(sessions) + 1)
+    await persistence.start()
+    start = time.perf_counter()
+    for session in sessions:
+        persistence.save(MODEL, session.user_id, session)
+    save_time = time.perf_counter() - start
+    start = time.perf_counter()
+    await persistence.flush()
+    flush_time = time.perf_counter() - start
+    await persistence.stop()
+    return save_time, flush_time
+
+
+async def churn(path, sessions, rate, seconds, flush_interval):
+    # updates arrive at ``rate`` per second while the flusher runs
+    persistence = SessionPersistence(path=path, flush_interval=flush_interval)
+    await persistence.start()
+    tick = 0.01
+    per_tick = max(int(rate * tick), 1)
+    updates = 0
+    max_dirty = 0
+    lag = 0.0
+    index = 0
+    start = time.perf_counter()
+    while time.perf_counter() - start < seconds:
+        tick_start = time.perf_counter()
+        for _ in range(per_tick):
+            session = sessions[index % len(sessions)]
+            session.update(parent_id="parent-{}".format(updates))
+            persistence.save(MODEL, session.user_id, session)
+            index += 7919
+            updates += 1
+        max_dirty = max(max_dirty, len(persistence.dirty))
+        sleep = tick - (time.perf_counter() - tick_start)
+        sleep_start = time.perf_counter()
+        await asyncio.sleep(max(sleep, 0))
+        # how late the event loop woke up, a blocked loop shows up here
+        lag = max(lag, time.perf_counter() - sleep_start - max(sleep, 0))
+    elapsed = time.perf_counter() - start
+    await persistence.stop()
+    return updates / elapsed, persistence.written, persistence.flushes, max_dirty, lag
+
+
+async def restore(path, limit):
+    persistence = SessionPersistence(path=path)
+    await persistence.start()
+    start = time.perf_counter()
+    rows = await persistence.load_recent(limit)
+    restore_time = time.perf_counter() - start
+    await persistence.stop()
+    return len(rows), restore_time
+
+
+async def run(args):
+    with tempfile.TemporaryDirectory() as directory:
+        path = os.path.join(directory, "bench.db")
+        sessions = make_sessions(args.users)
+
+        save_time, flush_time = await bulk(path, sessions)
+        print("users: {}".format(args.users))
+        print(
+            "save:    {:8.2f} us per call (request path)".format(
+                save_time / args.users * 1e6
+            )
+        )
+        print(
+            "flush:   {:8.0f} rows/s ({:.2f} ms for {} rows)".format(
+                args.users / flush_time, flush_time * 1000, args.users
+            )
+        )
+
+        rate, written, flushes, max_dirty, lag = await churn(
+            path, sessions, args.rate, args.seconds, args.flush_interval
+        )
+        print(
+            "churn:   {:8.0f} updates/s offered, {} rows written in {} flushes".format(
+                rate, written, flushes
+            )
+        )
+        print(
+            "         max pending: {}, max event loop lag: {:.2f} ms".format(
+                max_dirty, lag * 1000
+            )
+        )
+
+        restored, restore_time = await restore(path, args.users)
+        print(
+            "restore: {:8.2f} ms for {} sessions".format(restore_time * 1000, restored)
+        )
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--users", type=int, default=20000)
+    parser.add_argument("--rate", type=int, default=2000)
+    parser.add_argument("--seconds", type=float, default=5)
+    parser.add_argument("--flush-interval", type=float, default=1.0)
+    args = parser.parse_args()
+    asyncio.run(run(args))
+
+
+if __name__ == "__main__":
+    main()
@@ -1,25 +1,190 @@
+import asyncio
+import functools
 import logging
+import multiprocessing
+import os
+import signal
+import socket
+import tempfile
+from multiprocessing.connection import wait
 
-from route import app, set_session
+from hypercorn.asyncio import serve
+from hypercorn.config import Config as HypercornConfig
+
+from route import app, lifecycle, set_session
+from session.coordinator import CoordinatorClient, run_coordinator
 from session.session import Session
-from tool import load_config
+from tool import get_config_path, load_config, load_yaml
 from quart_cors import cors
 from os import environ
 
 
-def main():
-    environ.setdefault("CHATGPT_BASE_URL", "https://ai.fakeopen.com/api/")
+def setup_logging():
     logging.basicConfig(
         level=logging.INFO,
         format="%(asctime)s %(message)s",
         datefmt="%Y-%m-%d %H:%M:%S",
     )
     app.logger.setLevel(logging.INFO)
-    config = load_config()
-    session = Session(config=config)
+
+
+def configure_app(config):
+    stream_config = config["engine"].get("stream", {}) or {}
+    app.config["COALESCE_WINDOW"] = stream_config.get("coalesceWindow", 0)
+    app.config["COALESCE_BYTES"] = stream_config.get("coalesceBytes", 4096)
+    app.config["STREAM_QUEUE_SIZE"] = stream_config.get("queueSize", 64)
+    batch_config = config["engine"].get("batch", {}) or {}
+    app.config["BATCH_CONCURRENCY"] = batch_config.get("concurrency", 4)
+    app.config["BATCH_MAX_CONCURRENCY"] = batch_config.get("maxConcurrency", 16)
+    app.config["BATCH_MAX_ITEMS"] = batch_config.get("maxItems", 1000)
+
+
+async def drain(stop: asyncio.Event, delay, timeout):
+    """
+    Shutdown trigger: once signalled, refuse new chats and let /ready fail
+    for ``delay`` seconds so load balancers stop routing here, then wait up to
+    ``timeout`` seconds for requests in flight, streams included.
+    """
+    await stop.wait()
+    lifecycle.drain()
+    await asyncio.sleep(delay)
+    if not await lifecycle.wait_idle(timeout):
+        logging.warning("[Engine] drain timed out, {} requests in flight".format(lifecycle.active))
+
+
+async def serve_production(config, bind):
+    server_config = config["engine"].get("server", {}) or {}
+    hypercorn_config = HypercornConfig()
+    hypercorn_config.bind = [bind]
+    hypercorn_config.backlog = server_config.get("backlog", 2048)
+    # longer than the idle timeout of the proxy in front, so it closes first
+    hypercorn_config.keep_alive_timeout = server_config.get("keepAliveTimeout", 75)
+    # pipelined http/1.1 requests are read up to this size while one is served
+    hypercorn_config.h11_max_incomplete_size = server_config.get("maxIncompleteSize", 16 * 1024)
+    # drain handles the requests in flight, this only bounds closing idle connections
+    hypercorn_config.graceful_timeout = 5
+    hypercorn_config.accesslog = None
+    stop = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        loop.add_signal_handler(sig, stop.set)
+    await serve(
+        cors(app, allow_origin="*"),
+        hypercorn_config,
+        shutdown_trigger=functools.partial(
+            drain,
+            stop,
+            server_config.get("drainDelay", 5),
+            server_config.get("drainTimeout", 130),
+        ),
+    )
+
+
+def run_worker(config, sock: socket.socket, coordinator_path, config_path=None):
+    """Entry point of a worker process, it serves the listening socket shared by all workers."""
+    environ.setdefault("CHATGPT_BASE_URL", "https://ai.fakeopen.com/api/")
+    setup_logging()
+    if config_path is not None:
+        # a restarted worker starts with the accounts reloaded since the engine started
+        try:
+            config = load_yaml(config_path)
+        except Exception as e:
+            logging.error("[Engine] can not read {}, using the startup config: {}".format(config_path, e))
+    set_session(Session(config=config, coordinator=CoordinatorClient(coordinator_path), config_path=config_path))
+    configure_app(config)
+    asyncio.run(serve_production(config, "fd://{}".format(sock.fileno())))
+
+
+def run_workers(config, workers, config_path=None):
+    """
+    Run ``workers`` engine processes behind one port.
+
+    The parent binds the port and hands the socket to every worker, the
+    kernel spreads connections between them. Account slots, breakers and user
+    sessions are shared through a coordinator process. A worker that dies is
+    started again; SIGINT or SIGTERM drains the workers first, then stops
+    the coordinator.
+    """
+    port = config["engine"]["port"]
+    coordinator_path = config["engine"].get("coordinator") or os.path.join(
+        tempfile.gettempdir(), "chatgpt-engine-{}.sock".format(port)
+    )
+    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    sock.bind(("0.0.0.0", port))
+    sock.listen(2048)
+    sock.set_inheritable(True)
+
+    context = multiprocessing.get_context("spawn")
+    coordinator = context.Process(
+        target=run_coordinator, args=(coordinator_path, config), name="coordinator"
+    )
+    coordinator.start()
+
+    def start_worker(index):
+        process = context.Process(
+            target=run_worker,
+            args=(config, sock, coordinator_path, config_path),
+            name="worker-{}".format(index),
+        )
+        process.start()
+        return process
+
+    running = True
+
+    def shutdown(*_):
+        nonlocal running
+        running = False
+
+    # workers inherit the default handlers, the parent only coordinates shutdown
+    processes = [start_worker(i) for i in range(workers)]
+    signal.signal(signal.SIGINT, shutdown)
+    signal.signal(signal.SIGTERM, shutdown)
+    logging.info("[Engine] {} workers serving port {}".format(workers, port))
+
+    while running:
+        wait([p.sentinel for p in processes] + [coordinator.sentinel], timeout=1)
+        if not running:
+            break
+        if not coordinator.is_alive():
+            logging.error("[Engine] coordinator exited with {}, restarting".format(coordinator.exitcode))
+            coordinator = context.Process(
+                target=run_coordinator, args=(coordinator_path, config), name="coordinator"
+            )
+            coordinator.start()
+        for i, process in enumerate(processes):
+            if not process.is_alive():
+                logging.error("[Engine] {} exited with {}, restarting".format(process.name, process.exitcode))
+                processes[i] = start_worker(i)
+
+    for process in processes:
+        if process.is_alive():
+            process.terminate()
+    for process in processes:
+        process.join()
+    coordinator.terminate()
+    coordinator.join()
+    sock.close()
+
+
+def main():
+    environ.setdefault("CHATGPT_BASE_URL", "https://ai.fakeopen.com/api/")
+    setup_logging()
+    config_path = get_config_path()
+    config = load_config(config_path)
+    workers = config["engine"].get("workers", 1)
+    if workers > 1:
+        run_workers(config, workers, config_path)
+        return
+    session = Session(config=config, config_path=config_path)
     port = config["engine"]["port"]
     debug = config["engine"].get("debug", False)
     set_session(session)
+    configure_app(config)
+    server_config = config["engine"].get("server", {}) or {}
+    if server_config.get("mode", "development") == "production":
+        asyncio.run(serve_production(config, "0.0.0.0:{}".format(port)))
+        return
 
     cors_app = cors(app, allow_origin="*")
     cors_app.run(host="0.0.0.0", port=port, debug=debug)
@@ -1,12 +1,17 @@
 import asyncio
+import hmac
 import json
+import time
 import traceback
 from dataclasses import dataclass
+from enum import Enum
 
 from OpenAIAuth import Error as OpenAIError
 from quart import Quart, request, make_response
 from ChatGPT2API.typings import Error as ChatGPTError
 
+from session.admission import AdmissionRejected
+from session.ratelimit import RateLimited
 from session.session import Session
 
 app = Quart(__name__)
@@ -14,9 +19,21 @@ session: Session
 
 
 
+SUPPORTED_MODELS = ('gpt-4', 'text-davinci-002-render-sha', 'text-davinci-002-render-paid')
+
 STREAM_TIMEOUT = 'app_quart_stream_timeout'
 STREAM_DONE = 'app_quart_stream_done'
 
+MESSAGE_FRAME_PREFIX = b'data: {"message": '
+MESSAGE_FRAME_SUFFIX = b'}\nevent: event\r\n\r\n'
+
+# bounds of the coalesce_window (milliseconds) and coalesce_bytes a request may ask for
+COALESCE_MAX_WINDOW = 1000
+COALESCE_MAX_BYTES = 64 * 1024
+
+ADMIN_PREFIXES = ('/debug/', '/admin/')
+LOOPBACK_ADDRS = ('127.0.0.1', '::1')
+
 
 @dataclass
 class ServerSentEvent:
@@ -24,11 +41,14 @@ class ServerSentEvent:
     event: str = 'event'
     id: int = None
     retry: int = None
+    # more fields of the message object, e.g. the retry_after of a rejection
+    fields: dict = None
 
     def encode(self) -> bytes:
         if self.data != '[DONE]' and self.data != '[START]' and self.data != '[KEEP]':
             self.data = json.dumps({
                 'message': self.data,
+                **(self.fields or {}),
             })
         message = f"data: {self.data}"
         if self.event is not None:
@@ -40,6 +60,11 @@ class ServerSentEvent:
         message = f"{message}\r\n\r\n"
         return message.encode('utf-8')
 
+    @staticmethod
+    def encode_message(message: str) -> bytes:
+        # same bytes as ServerSentEvent(message).encode() without building the event
+        return MESSAGE_FRAME_PREFIX + json.dumps(message).encode('utf-8') + MESSAGE_FRAME_SUFFIX
+
     @staticmethod
     def done_event():
         return ServerSentEvent("[DONE]", event="event")
@@ -52,86 +77,428 @@ class ServerSentEvent:
     def keep_event():
         return ServerSentEvent("[KEEP]", event="event")
 
+    @staticmethod
+    def rejected_event(e: AdmissionRejected):
+        # the same code and retry_after as the 429 of /chat, retry tells EventSource when to come back
+        return ServerSentEvent(
+            e.message,
+            event="event",
+            retry=e.retry_after * 1000,
+            fields={"code": e.code, "retry_after": e.retry_after},
+        )
 
-@app.route('/chat', methods=["GET"])
-async def chat():
-    sentence = request.args.get("sentence")
-    user_id = request.args.get("user_id")
-    model = request.args.get("model") or 'text-davinci-002-render-sha'
-    if model not in ['gpt-4', 'text-davinci-002-render-sha', 'text-davinci-002-render-paid']:
-        raise Exception("model not supported")
+
+START_FRAME = ServerSentEvent.start_event().encode()
+DONE_FRAME = ServerSentEvent.done_event().encode()
+KEEP_FRAME = ServerSentEvent.keep_event().encode()
+
+
+class StreamStats:
+    """
+    Count streams whose client went away or timed out before upstream finished.
+
+    The upstream time saved by cancelling them is estimated from the moving
+    average duration of completed streams.
+    """
+
+    def __init__(self, alpha=0.1):
+        self.alpha = alpha
+        self.completed = 0
+        self.abandoned = {'disconnect': 0, 'timeout': 0}
+        self.ewma_duration = None
+        self.saved_upstream_seconds = 0.0
+
+    def complete(self, duration):
+        self.completed += 1
+        if self.ewma_duration is None:
+            self.ewma_duration = duration
+        else:
+            self.ewma_duration = self.alpha * duration + (1 - self.alpha) * self.ewma_duration
+
+    def abandon(self, reason, elapsed):
+        self.abandoned[reason] = self.abandoned.get(reason, 0) + 1
+        if self.ewma_duration is not None:
+            self.saved_upstream_seconds += max(self.ewma_duration - elapsed, 0)
+        app.logger.info("[Engine] stream abandoned: {} after {:.2f}s".format(reason, elapsed))
+
+    def snapshot(self):
+        return {
+            'completed': self.completed,
+            'abandoned': dict(self.abandoned),
+            'ewma_duration': self.ewma_duration,
+            'saved_upstream_seconds': self.saved_upstream_seconds,
+        }
+
+
+stream_stats = StreamStats()
+
+
+class Lifecycle:
+    """Requests in flight and whether the engine is draining for shutdown."""
+
+    def __init__(self):
+        self.draining = False
+        self.active = 0
+        self.streams = 0
+
+    def drain(self):
+        self.draining = True
+        app.logger.info("[Engine] draining, {} requests in flight".format(self.active))
+
+    async def wait_idle(self, timeout):
+        loop = asyncio.get_event_loop()
+        deadline = loop.time() + timeout
+        while self.active > 0 and loop.time() < deadline:
+            await asyncio.sleep(0.1)
+        return self.active == 0
+
+
+lifecycle = Lifecycle()
+
+
+class RouteMetrics:
+    """Request counters and gauges of the http layer, kept in the registry of the session."""
+
+    def __init__(self, s: Session):
+        self.requests = s.metrics.counter(
+            'engine_requests_total', 'Chat requests by endpoint and result', ('endpoint', 'model', 'result'))
+        self.stage_seconds = s.stage_seconds
+        s.metrics.gauge('engine_active_requests', 'Chat requests in flight', (), lambda: {(): lifecycle.active})
+        s.metrics.gauge('engine_active_streams', 'Streams in flight', (), lambda: {(): lifecycle.streams})
+
+
+route_metrics: RouteMetrics
+
+
+def draining_response():
+    detail = "😱 机器人正在重启，请稍后再试(The robot is restarting, please retry later)"
+    return {"detail": detail, "code": 503}, 503, {"Retry-After": "5"}
+
+
+class StreamCoalescer:
+    """
+    Batch stream deltas into one sse frame per time window or byte budget.
+
+    The first delta is always sent on its own so time to first token is not
+    delayed, later deltas wait at most ``window`` seconds. A window of 0
+    disables batching.
+    """
+
+    def __init__(self, window=0.0, max_bytes=4096):
+        self.window = window
+        self.max_bytes = max_bytes
+        self.pending = []
+        self.size = 0
+        self.deadline = None
+        self.started = False
+
+    def add(self, message: str, now: float):
+        if not self.started or self.window <= 0:
+            self.started = True
+            return ServerSentEvent.encode_message(message)
+        self.pending.append(message)
+        self.size += len(message)
+        if self.deadline is None:
+            self.deadline = now + self.window
+        if self.size >= self.max_bytes:
+            return self.flush()
+        return None
+
+    def timeout(self, now: float, default: float) -> float:
+        if len(self.pending) == 0:
+            return default
+        return max(self.deadline - now, 0)
+
+    def flush(self):
+        if len(self.pending) == 0:
+            return None
+        frame = ServerSentEvent.encode_message(''.join(self.pending))
+        self.pending = []
+        self.size = 0
+        self.deadline = None
+        return frame
+
+
+@app.before_request
+async def check_admin():
+    """Guard the debug and admin endpoints with the admin token, or loopback only without one."""
+    if not request.path.startswith(ADMIN_PREFIXES):
+        return None
+    token = (session.config["engine"].get("admin", {}) or {}).get("token")
+    if token:
+        auth = request.headers.get("Authorization", "")
+        if hmac.compare_digest(auth.encode(), "Bearer {}".format(token).encode()):
+            return None
+    elif request.remote_addr in LOOPBACK_ADDRS:
+        return None
+    return {"detail": "Forbidden", "code": 403}, 403
+
+
+def non_negative_number(value, limit):
+    return isinstance(value, (int, float)) and not isinstance(value, bool) and 0 <= value <= limit
+
+
+def error_code(code):
+    # ChatGPT2API error types are plain enums, json needs their value
+    return code.value if isinstance(code, Enum) else code
+
+
+async def ask(sentence, user_id, model, stateless, client, batched=False):
+    """Answer one prompt, return the response body and the result counted in metrics."""
     try:
-        res = await session.chat_with_chatgpt(sentence, user_id=user_id, model=model)
-        return {"message": res}
+        if batched:
+            # the batch was counted against the user limits of its client already
+            session.check_rate_limit(None, model)
+        else:
+            session.check_rate_limit(user_id, model, client)
+        res = await session.chat_with_chatgpt(sentence, user_id=user_id, model=model, stateless=stateless)
+        return {"message": res}, 'ok'
+    except AdmissionRejected as e:
+        return {"detail": e.message, "code": e.code, "retry_after": e.retry_after}, 'rejected'
     except OpenAIError as e:
         app.logger.error(
             "[Engine] chat gpt engine get open api error: status: {}, details: {}".format(e.status_code, e.details))
-        return {"detail": e.details, "code": e.status_code}
+        return {"detail": e.details, "code": e.status_code}, 'error'
     except ChatGPTError as e:
         app.logger.error("[Engine] chat gpt engine get chat gpt error: {}".format(e.message))
-        return {"detail": e.message, "code": e.code}
+        return {"detail": e.message, "code": error_code(e.code)}, 'error'
     except Exception as e:
         app.logger.error(f"[Engine] chat gpt engine get error: {traceback.format_exc()}")
-        return {"detail": str(e) if len(str(e)) != 0 else "Internal Server Error", "code": 500}
+        return {"detail": str(e) if len(str(e)) != 0 else "Internal Server Error", "code": 500}, 'error'
+
+
+@app.route('/chat', methods=["GET"])
+async def chat():
+    sentence = request.args.get("sentence")
+    user_id = request.args.get("user_id")
+    model = request.args.get("model") or 'text-davinci-002-render-sha'
+    stateless = request.args.get("stateless") in ('1', 'true')
+    if model not in SUPPORTED_MODELS:
+        raise Exception("model not supported")
+    if lifecycle.draining:
+        return draining_response()
+    lifecycle.active += 1
+    result = 'error'
+    try:
+        body, result = await ask(sentence, user_id, model, stateless, request.remote_addr)
+        if result == 'rejected':
+            return body, 429, {"Retry-After": str(body["retry_after"])}
+        return body
+    finally:
+        lifecycle.active -= 1
+        route_metrics.requests.inc(('chat', model, result))
+
+
+@app.route('/chat-batch', methods=["POST"])
+async def chat_batch():
+    """
+    Answer many independent prompts, one ndjson line per item as soon as it is done.
+
+    Items are answered in parallel on the free accounts, at most
+    ``concurrency`` at a time. Every item counts against the batch or user
+    rate limits of the client up front, and against the account and engine
+    limits once it runs. Items are stateless unless they set ``stateless`` to
+    false, so items of one user do not chain into one conversation. Every
+    line carries the ``index`` of its item and either a message or the error
+    of that item alone, the last line counts the results.
+    """
+    request_data = await request.get_json(silent=True)
+    if not isinstance(request_data, dict):
+        return {"detail": "body must be a json object", "code": 400}, 400
+    items = request_data.get("items")
+    if not isinstance(items, list) or len(items) == 0:
+        return {"detail": "items must be a non-empty list", "code": 400}, 400
+    if len(items) > app.config.get("BATCH_MAX_ITEMS", 1000):
+        return {"detail": "too many items, at most {}".format(app.config.get("BATCH_MAX_ITEMS", 1000)), "code": 400}, 400
+    for index, item in enumerate(items):
+        if not isinstance(item, dict) or not item.get("sentence"):
+            return {"detail": "item {} has no sentence".format(index), "code": 400}, 400
+        if (item.get("model") or 'text-davinci-002-render-sha') not in SUPPORTED_MODELS:
+            return {"detail": "item {}: model not supported".format(index), "code": 400}, 400
+    if lifecycle.draining:
+        return draining_response()
+    concurrency = request_data.get("concurrency", app.config.get("BATCH_CONCURRENCY", 4))
+    if not isinstance(concurrency, int):
+        return {"detail": "concurrency must be an integer", "code": 400}, 400
+    # more parallel items than the pool has slots would only wait for admission
+    concurrency = max(1, min(concurrency, app.config.get("BATCH_MAX_CONCURRENCY", 16), session.capacity()))
+    client = request.remote_addr
+    try:
+        session.check_batch_rate_limit(
+            [item.get("model") or 'text-davinci-002-render-sha' for item in items], client)
+    except RateLimited as e:
+        return {"detail": e.message, "code": e.code, "retry_after": e.retry_after}, 429, {"Retry-After": str(e.retry_after)}
+
+    async def run(index, item, slots):
+        model = item.get("model") or 'text-davinci-002-render-sha'
+        # items are independent prompts unless one asks to continue the conversation of its user
+        stateless = bool(item.get("stateless", True))
+        user_id = None if stateless else item.get("user_id")
+        async with slots:
+            body, result = await ask(item["sentence"], user_id, model, stateless, client, batched=True)
+        route_metrics.requests.inc(('chat-batch', model, result))
+        line = {"index": index}
+        if "id" in item:
+            line["id"] = item["id"]
+        line.update(body)
+        return line, result
+
+    async def send_lines():
+        lifecycle.active += 1
+        lifecycle.streams += 1
+        slots = asyncio.Semaphore(concurrency)
+        tasks = [asyncio.create_task(run(index, item, slots)) for index, item in enumerate(items)]
+        results = {'ok': 0, 'rejected': 0, 'error': 0}
+        try:
+            for done in asyncio.as_completed(tasks):
+                line, result = await done
+                results[result] += 1
+                yield json.dumps(line, ensure_ascii=False).encode('utf-8') + b'\n'
+            yield json.dumps({"done": True, "total": len(items), **results}).encode('utf-8') + b'\n'
+        finally:
+            # a client that went away takes the unanswered items with it
+            for task in tasks:
+                task.cancel()
+            lifecycle.active -= 1
+            lifecycle.streams -= 1
+
+    response = await make_response(
+        send_lines(),
+        {
+            'Content-Type': 'application/x-ndjson',
+            'Cache-Control': 'no-cache, no-transform',
+            'Transfer-Encoding': 'chunked',
+        },
+    )
+    response.timeout = None
+    return response
 
 
 @app.route('/chat-stream', methods=["POST"])
 async def chat_stream():
-    request_data = await request.get_json()
+    request_data = await request.get_json(silent=True)
+    if not isinstance(request_data, dict):
+        return {"detail": "body must be a json object", "code": 400}, 400
     sentence = request_data.get("sentence")
     user_id = request_data.get("user_id")
     model = request_data.get("model") or 'text-davinci-002-render-sha'
-    if model not in ['gpt-4', 'text-davinci-002-render-sha', 'text-davinci-002-render-paid']:
+    stateless = bool(request_data.get("stateless", False))
+    if model not in SUPPORTED_MODELS:
         raise Exception("model not supported")
-    start_time = asyncio.get_event_loop().time()
+    coalesce_window = request_data.get("coalesce_window", app.config.get("COALESCE_WINDOW", 0))
+    coalesce_bytes = request_data.get("coalesce_bytes", app.config.get("COALESCE_BYTES", 4096))
+    if not non_negative_number(coalesce_window, COALESCE_MAX_WINDOW):
+        return {"detail": "coalesce_window must be 0 to {} milliseconds".format(COALESCE_MAX_WINDOW), "code": 400}, 400
+    if not non_negative_number(coalesce_bytes, COALESCE_MAX_BYTES):
+        return {"detail": "coalesce_bytes must be 0 to {}".format(COALESCE_MAX_BYTES), "code": 400}, 400
+    if lifecycle.draining:
+        return draining_response()
+    try:
+        session.check_rate_limit(user_id, model, request.remote_addr)
+    except RateLimited as e:
+        route_metrics.requests.inc(('chat-stream', model, 'rejected'))
+        return {"detail": e.message, "code": e.code, "retry_after": e.retry_after}, 429, {"Retry-After": str(e.retry_after)}
+    loop = asyncio.get_event_loop()
+    start_time = loop.time()
 
     async def send_events():
-        should_stop = False
-
         async def put_stream_to_queue(stream, queue):
+            nonlocal result
             try:
                 async for message in stream:
-                    if should_stop is True:
-                        break
                     await queue.put(message)
+            except AdmissionRejected as e:
+                result = 'rejected'
+                await queue.put(e)
             except ChatGPTError as e:
+                result = 'error'
                 await queue.put(e.message)
             except OpenAIError as exception:
+                result = 'error'
                 await queue.put(exception.details)
             except Exception as exception:
+                result = 'error'
                 msg = str(exception) if len(str(exception)) != 0 else "Internal Server Error"
                 await queue.put(msg)
             finally:
-                await queue.put(STREAM_DONE)
+                # closes the upstream response and frees the account slot,
+                # also when this task is cancelled
+                await stream.aclose()
+            await queue.put(STREAM_DONE)
 
+        coalescer = StreamCoalescer(window=coalesce_window / 1000, max_bytes=coalesce_bytes)
+        producer = None
+        abandon_reason = 'disconnect'
+        result = 'ok'
+        # seconds spent encoding frames and waiting for the client to take them
+        encode_time = 0.0
+        write_time = 0.0
+        # counted from the first frame, a body that is never sent runs no finally
+        lifecycle.active += 1
+        lifecycle.streams += 1
         try:
-            yield ServerSentEvent.start_event().encode()
+            yield START_FRAME
 
-            stream_generator = session.chat_stream_with_chatgpt(sentence, user_id=user_id, model=model)
-            queue = asyncio.Queue()
-            asyncio.create_task(put_stream_to_queue(stream_generator, queue))
+            stream_generator = session.chat_stream_with_chatgpt(
+                sentence, user_id=user_id, model=model, stateless=stateless)
+            # bounded so a slow client pauses the upstream read instead of buffering it
+            queue = asyncio.Queue(maxsize=app.config.get("STREAM_QUEUE_SIZE", 64))
+            producer = asyncio.create_task(put_stream_to_queue(stream_generator, queue))
 
             while True:
                 try:
-                    message = await asyncio.wait_for(queue.get(), timeout=12)
+                    message = await asyncio.wait_for(queue.get(), timeout=coalescer.timeout(loop.time(), 12))
                 except asyncio.TimeoutError:
+                    encode_start = time.perf_counter()
+                    frame = coalescer.flush()
+                    encode_time += time.perf_counter() - encode_start
+                    if frame is not None:
+                        write_start = time.perf_counter()
+                        yield frame
+                        write_time += time.perf_counter() - write_start
+                        continue
                     message = STREAM_TIMEOUT
 
-                if queue.empty() and message is STREAM_DONE:
+                if message is STREAM_DONE:
+                    stream_stats.complete(loop.time() - start_time)
                     break
                 if message is STREAM_TIMEOUT:
-                    current_time = asyncio.get_event_loop().time()
+                    current_time = loop.time()
                     if current_time - start_time > 120:
-                        should_stop = True
+                        abandon_reason = 'timeout'
                         app.logger.warning("[Engine] chat gpt engine get stream timeout")
                         yield ServerSentEvent(
                             "😱 机器人负载过多，请稍后再试(The robot is overwhelmed, please try again later)").encode()
                         break
-                    yield ServerSentEvent.keep_event().encode()
+                    yield KEEP_FRAME
+                elif isinstance(message, AdmissionRejected):
+                    frame = coalescer.flush()
+                    if frame is not None:
+                        yield frame
+                    yield ServerSentEvent.rejected_event(message).encode()
                 else:
-                    yield ServerSentEvent(message).encode()
+                    encode_start = time.perf_counter()
+                    frame = coalescer.add(message, loop.time())
+                    encode_time += time.perf_counter() - encode_start
+                    if frame is not None:
+                        write_start = time.perf_counter()
+                        yield frame
+                        write_time += time.perf_counter() - write_start
+
+            frame = coalescer.flush()
+            if frame is not None:
+                yield frame
+            yield DONE_FRAME
         finally:
-            yield ServerSentEvent.done_event().encode()
+            lifecycle.active -= 1
+            lifecycle.streams -= 1
+            if producer is not None and not producer.done():
+                producer.cancel()
+                stream_stats.abandon(abandon_reason, loop.time() - start_time)
+                result = 'abandoned'
+            route_metrics.requests.inc(('chat-stream', model, result))
+            route_metrics.stage_seconds.observe(('sse_encode', model, ''), encode_time)
+            route_metrics.stage_seconds.observe(('sse_write', model, ''), write_time)
 
     response = await make_response(
         send_events(),
@@ -150,6 +517,119 @@ def ping():
     return "pong"
 
 
+@app.route('/metrics')
+async def metrics():
+    snapshots = [session.metrics.snapshot()]
+    if session.coordinator is not None:
+        try:
+            snapshots += await session.coordinator.metrics()
+        except ConnectionError as e:
+            app.logger.warning("[Engine] metrics of the other workers unavailable: {}".format(e))
+    return session.metrics.render(snapshots), 200, {'Content-Type': 'text/plain; version=0.0.4'}
+
+
+@app.route('/ready')
+def ready():
+    # unlike /ping this fails while draining or without enough healthy accounts
+    status = session.readiness()
+    status['draining'] = lifecycle.draining
+    status['active'] = lifecycle.active
+    status['ready'] = status['ready'] and not lifecycle.draining
+    return status, 200 if status['ready'] else 503
+
+
+@app.route('/debug/scheduler')
+def debug_scheduler():
+    return session.scheduler.snapshot()
+
+
+@app.route('/debug/breakers')
+def debug_breakers():
+    return session.breaker_snapshot()
+
+
+@app.route('/debug/failover')
+def debug_failover():
+    return session.failover_stats
+
+
+@app.route('/debug/hedging')
+def debug_hedging():
+    return session.hedging.snapshot()
+
+
+@app.route('/debug/affinity')
+def debug_affinity():
+    return session.affinity.snapshot()
+
+
+@app.route('/debug/admission')
+def debug_admission():
+    return session.admission.snapshot()
+
+
+@app.route('/debug/streams')
+def debug_streams():
+    return stream_stats.snapshot()
+
+
+@app.route('/debug/prompt-cache')
+def debug_prompt_cache():
+    return session.prompt_cache.snapshot()
+
+
+@app.route('/debug/rate-limit')
+def debug_rate_limit():
+    return session.rate_limiter.snapshot()
+
+
+@app.route('/debug/transport')
+def debug_transport():
+    return session.transport.snapshot()
+
+
+@app.route('/debug/sessions')
+def debug_sessions():
+    stats = session.user_sessions.stats()
+    stats["persistence"] = session.persistence.stats()
+    return stats
+
+
+@app.route('/admin/reload', methods=["POST"])
+async def admin_reload():
+    # every worker reloads, the others are told through the coordinator
+    try:
+        result = await session.reload_from_file(publish=True)
+    except Exception as e:
+        return {"detail": "reload failed: {}".format(e), "code": 500}, 500
+    return result
+
+
+@app.route('/debug/reload')
+def debug_reload():
+    return session.reload_snapshot()
+
+
+@app.route('/debug/coordinator')
+async def debug_coordinator():
+    if session.coordinator is None:
+        return {'enabled': False}
+    stats = await session.coordinator.stats()
+    stats['enabled'] = True
+    return stats
+
+
+@app.before_serving
+async def startup():
+    await session.start()
+
+
+@app.after_serving
+async def shutdown():
+    await session.stop()
+
+
 def set_session(s: Session):
-    global session
+    global session, route_metrics
     session = s
+    route_metrics = RouteMetrics(s)
@@ -0,0 +1,164 @@
+import asyncio
+import logging
+import math
+import time
+from collections import deque
+from contextlib import asynccontextmanager
+from typing import Callable, Dict
+
+from ChatGPT2API.typings import Error as ChatGPTError
+
+
+class AdmissionRejected(ChatGPTError):
+    def __init__(self, message, retry_after):
+        super().__init__(source="admission", message=message, code=429)
+        self.retry_after = retry_after
+
+
+class AdmissionController:
+    """
+    Bound the requests running in the engine to the capacity of the pool.
+
+    Requests beyond capacity wait in a bounded queue per model. Freed capacity
+    goes to the waiting models by stride scheduling on their weights, and a
+    request is rejected with a retry-after hint when its queue is full or it
+    waited longer than ``max_wait`` seconds.
+    """
+
+    def __init__(
+        self,
+        capacity: Callable[[], int],
+        models: Dict[str, dict] = None,
+        queue_size=100,
+        weight=1,
+        max_wait=30,
+        enabled=True,
+    ):
+        self.capacity = capacity
+        self.models = models or {}
+        self.queue_size = queue_size
+        self.weight = weight
+        self.max_wait = max_wait
+        self.enabled = enabled
+        self.active = 0
+        self.queues: Dict[str, deque] = {}
+        self.passes: Dict[str, float] = {}
+        self.virtual_time = 0.0
+        self.service_time = None
+        self.admitted = 0
+        self.rejected = {"queue_full": 0, "timeout": 0}
+
+    @staticmethod
+    def from_config(capacity: Callable[[], int], config) -> "AdmissionController":
+        admission_config = config["engine"].get("admission")
+        if admission_config is None:
+            return AdmissionController(capacity, enabled=False)
+        return AdmissionController(
+            capacity,
+            models=admission_config.get("models", {}) or {},
+            queue_size=admission_config.get("queueSize", 100),
+            weight=admission_config.get("weight", 1),
+            max_wait=admission_config.get("maxWait", 30),
+        )
+
+    def _model_option(self, model, key, default):
+        return (self.models.get(model) or {}).get(key, default)
+
+    def waiting(self):
+        return sum(len(q) for q in self.queues.values())
+
+    def retry_after(self) -> int:
+        service_time = self.service_time if self.service_time is not None else 10
+        capacity = max(self.capacity(), 1)
+        return max(1, math.ceil((self.waiting() + 1) * service_time / capacity))
+
+    def _reject(self, reason, model):
+        self.rejected[reason] += 1
+        retry_after = self.retry_after()
+        logging.warning(
+            "[Admission] reject {} request: {}, retry after {}s".format(
+                model, reason, retry_after
+            )
+        )
+        return AdmissionRejected(
+            "😱 机器人负载过多，请{}秒后再试(The robot is overwhelmed, please retry after {}s)".format(
+                retry_after, retry_after
+            ),
+            retry_after,
+        )
+
+    async def acquire(self, model):
+        if self.active < self.capacity() and self.waiting() == 0:
+            self.active += 1
+            self.admitted += 1
+            return
+        queue = self.queues.setdefault(model, deque())
+        if len(queue) >= self._model_option(model, "queueSize", self.queue_size):
+            raise self._reject("queue_full", model)
+        if len(queue) == 0:
+            # an idle model does not bank credit while it had nothing queued
+            self.passes[model] = max(self.passes.get(model, 0.0), self.virtual_time)
+        waiter = asyncio.get_running_loop().create_future()
+        queue.append(waiter)
+        self._dispatch()
+        try:
+            await asyncio.wait_for(waiter, timeout=self.max_wait)
+        except asyncio.TimeoutError:
+            if waiter in queue:
+                queue.remove(waiter)
+            raise self._reject("timeout", model)
+        except asyncio.CancelledError:
+            if waiter in queue:
+                queue.remove(waiter)
+            elif waiter.done() and not waiter.cancelled():
+                self.release()
+            raise
+        self.admitted += 1
+
+    def release(self):
+        self.active -= 1
+        self._dispatch()
+
+    def _dispatch(self):
+        while self.active < self.capacity():
+            model = None
+            for name, queue in self.queues.items():
+                if len(queue) != 0 and (model is None or self.passes[name] < self.passes[model]):
+                    model = name
+            if model is None:
+                return
+            waiter = self.queues[model].popleft()
+            if waiter.done():
+                continue
+            self.virtual_time = self.passes[model]
+            self.passes[model] += 1 / self._model_option(model, "weight", self.weight)
+            self.active += 1
+            waiter.set_result(None)
+
+    @asynccontextmanager
+    async def admit(self, model):
+        if not self.enabled:
+            yield
+            return
+        await self.acquire(model)
+        start_time = time.monotonic()
+        try:
+            yield
+        finally:
+            duration = time.monotonic() - start_time
+            if self.service_time is None:
+                self.service_time = duration
+            else:
+                self.service_time = 0.1 * duration + 0.9 * self.service_time
+            self.release()
+
+    def snapshot(self):
+        return {
+            "enabled": self.enabled,
+            "active": self.active,
+            "capacity": self.capacity(),
+            "queues": {model: len(queue) for model, queue in self.queues.items()},
+            "admitted": self.admitted,
+            "rejected": dict(self.rejected),
+            "service_time": self.service_time,
+        }
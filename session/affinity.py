@@ -0,0 +1,50 @@
+from collections import OrderedDict
+from typing import Optional
+
+
+class AffinityIndex:
+    """
+    Map each upstream conversation to the email of the account that owns it.
+
+    A conversation only exists on the account it was started on, so follow-up
+    messages go back to that account; the index is bounded and forgets the
+    least recently used conversations first.
+    """
+
+    def __init__(self, max_size=50000):
+        self.max_size = max_size
+        self.owners: "OrderedDict[str, str]" = OrderedDict()
+        self.hits = 0
+        self.misses = {"unknown": 0, "unavailable": 0, "overloaded": 0}
+
+    def __len__(self):
+        return len(self.owners)
+
+    def bind(self, conversation_id, email):
+        if conversation_id is None:
+            return
+        self.owners[conversation_id] = email
+        self.owners.move_to_end(conversation_id)
+        if len(self.owners) > self.max_size:
+            self.owners.popitem(last=False)
+
+    def owner(self, conversation_id) -> Optional[str]:
+        email = self.owners.get(conversation_id)
+        if email is not None:
+            self.owners.move_to_end(conversation_id)
+        return email
+
+    def hit(self):
+        self.hits += 1
+
+    def miss(self, reason):
+        self.misses[reason] += 1
+
+    def snapshot(self):
+        misses = sum(self.misses.values())
+        return {
+            "size": len(self.owners),
+            "hits": self.hits,
+            "misses": dict(self.misses),
+            "hit_rate": self.hits / (self.hits + misses) if self.hits + misses else 0,
+        }
@@ -0,0 +1,130 @@
+import logging
+import time
+
+CLOSED = "closed"
+OPEN = "open"
+HALF_OPEN = "half-open"
+
+
+class CircuitBreaker:
+    """
+    Health state of one account.
+
+    ``failure_threshold`` consecutive failures, or a single rate limit, open
+    the breaker for ``cooldown`` seconds. Once that passes it is half-open and
+    lets one probe request through: success closes it, failure opens it again
+    with the cooldown doubled up to ``max_cooldown``.
+    """
+
+    __slots__ = (
+        "name",
+        "failure_threshold",
+        "base_cooldown",
+        "max_cooldown",
+        "cooldown",
+        "failures",
+        "opened",
+        "opened_until",
+        "probing",
+        "on_change",
+    )
+
+    def __init__(self, name="", failure_threshold=3, cooldown=60, max_cooldown=900, on_change=None):
+        self.name = name
+        self.failure_threshold = failure_threshold
+        self.base_cooldown = cooldown
+        self.max_cooldown = max_cooldown
+        self.cooldown = cooldown
+        self.failures = 0
+        self.opened = False
+        self.opened_until = 0.0
+        self.probing = False
+        self.on_change = on_change
+
+    @property
+    def state(self):
+        if not self.opened:
+            return CLOSED
+        if time.monotonic() < self.opened_until:
+            return OPEN
+        return HALF_OPEN
+
+    def available(self):
+        state = self.state
+        if state == CLOSED:
+            return True
+        return state == HALF_OPEN and not self.probing
+
+    def retry_in(self):
+        """Seconds until the breaker lets a probe through, 0 when it does now."""
+        return max(self.opened_until - time.monotonic(), 0) if self.opened else 0
+
+    def on_acquire(self):
+        if self.state == HALF_OPEN:
+            self.probing = True
+
+    def on_release(self):
+        # a probe that ended without a verdict, e.g. a cancelled stream
+        self.probing = False
+
+    def record_success(self):
+        changed = self.opened
+        self.failures = 0
+        self.opened = False
+        self.probing = False
+        self.cooldown = self.base_cooldown
+        if changed:
+            logging.info("[Breaker] {} closed".format(self.name))
+            self._changed()
+
+    def record_failure(self, rate_limited=False):
+        self.failures += 1
+        state = self.state
+        if state == OPEN:
+            # requests that started before the breaker opened
+            return
+        if state == HALF_OPEN:
+            # the probe failed, back off further
+            self.cooldown = min(self.cooldown * 2, self.max_cooldown)
+        elif not rate_limited and self.failures < self.failure_threshold:
+            return
+        self.opened = True
+        self.probing = False
+        self.opened_until = time.monotonic() + self.cooldown
+        logging.warning(
+            "[Breaker] {} open for {}s, failures: {}, rate limited: {}".format(
+                self.name, self.cooldown, self.failures, rate_limited
+            )
+        )
+        self._changed()
+
+    def share(self):
+        """State sent to the other workers, the cooldown left is relative so clocks need not agree."""
+        return {
+            "opened": self.opened,
+            "retry_in": self.retry_in(),
+            "cooldown": self.cooldown,
+        }
+
+    def apply(self, state):
+        """Take over the state another worker saw for the same account."""
+        self.opened = state["opened"]
+        self.opened_until = time.monotonic() + state["retry_in"]
+        self.cooldown = state["cooldown"]
+        self.probing = False
+        if not self.opened:
+            self.failures = 0
+        logging.info("[Breaker] {} {} by another worker".format(self.name, self.state))
+        self._changed()
+
+    def _changed(self):
+        if self.on_change is not None:
+            self.on_change()
+
+    def snapshot(self):
+        return {
+            "state": self.state,
+            "failures": self.failures,
+            "cooldown": self.cooldown,
+            "retry_in": self.retry_in(),
+        }
@@ -0,0 +1,520 @@
+import asyncio
+import itertools
+import json
+import logging
+import os
+import signal
+import time
+from collections import OrderedDict, deque
+from typing import Callable, Dict, Optional
+
+import httpx
+
+from .credential import (
+    REFRESH_MIN_INTERVAL,
+    RENEW_FALLBACK_INTERVAL,
+    RENEW_RETRY_INTERVAL,
+    Credential,
+)
+from .metrics import merge_snapshots
+
+RECONNECT_INTERVAL = 1
+# longest json line, metrics snapshots of many accounts outgrow the 64 KiB default
+MESSAGE_LIMIT = 16 * 1024 * 1024
+
+
+def encode(message) -> bytes:
+    return json.dumps(message, separators=(",", ":")).encode("utf-8") + b"\n"
+
+
+class Lease:
+    __slots__ = ("held", "waiters")
+
+    def __init__(self):
+        self.held = 0
+        self.waiters = deque()
+
+
+class AccountToken:
+    __slots__ = ("access_token", "refresh_token", "refreshing", "refreshed_at", "renewer")
+
+    def __init__(self, access_token, refresh_token):
+        self.access_token = access_token
+        self.refresh_token = refresh_token
+        self.refreshing = None
+        self.refreshed_at = float("-inf")
+        self.renewer = None
+
+
+class Coordinator:
+    """
+    State shared by the worker processes of one engine, served on a unix socket.
+
+    It hands out the concurrency slots of every account so that two workers
+    never use the same slot, relays breaker changes and rate limit tokens taken
+    between workers and holds
+    the user sessions, so a user may be served by any worker. It alone
+    refreshes and renews the access tokens of the accounts, refresh tokens
+    rotate and must not be spent once per worker. Messages are json lines;
+    requests carrying an ``id`` get a reply with the same id.
+    """
+
+    def __init__(self, path, max_sessions=10000, session_ttl=86400, refresh_ahead=600):
+        self.path = path
+        self.max_sessions = max_sessions
+        self.session_ttl = session_ttl
+        self.refresh_ahead = refresh_ahead
+        self.tokens: Dict[str, AccountToken] = {}
+        self.client = None
+        self.tasks = set()
+        self.leases: Dict[str, Lease] = {}
+        self.breakers: Dict[str, dict] = {}
+        self.sessions: "OrderedDict[tuple, list]" = OrderedDict()
+        self.writers = set()
+        # latest metrics snapshot of every worker
+        self.metrics = {}
+        self.server = None
+
+    @staticmethod
+    def from_config(path, config) -> "Coordinator":
+        store_config = config["engine"].get("session", {}) or {}
+        return Coordinator(
+            path,
+            max_sessions=store_config.get("maxSize", 10000),
+            session_ttl=store_config.get("ttl", 86400),
+            refresh_ahead=config["engine"]["chatgpt"].get("refreshAhead", 600),
+        )
+
+    async def start(self):
+        if os.path.exists(self.path):
+            os.remove(self.path)
+        self.server = await asyncio.start_unix_server(
+            self._serve, path=self.path, limit=MESSAGE_LIMIT
+        )
+        logging.info("[Coordinator] listening on {}".format(self.path))
+
+    async def serve_forever(self):
+        await self.start()
+        async with self.server:
+            await self.server.serve_forever()
+
+    async def _serve(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        self.writers.add(writer)
+        held: Dict[str, int] = {}
+        for email, state in self.breakers.items():
+            writer.write(encode({"op": "breaker", "email": email, "state": state}))
+        for email, lease in self.leases.items():
+            writer.write(encode({"op": "held", "email": email, "held": lease.held}))
+        try:
+            while True:
+                line = await reader.readline()
+                if not line:
+                    break
+                self._handle(json.loads(line), writer, held)
+        except (ConnectionError, asyncio.IncompleteReadError):
+            pass
+        except Exception as e:
+            # e.g. an overlong line or bad json, the worker reconnects and starts clean
+            logging.error("[Coordinator] dropping a worker connection: {}".format(e))
+        finally:
+            self.writers.discard(writer)
+            self.metrics.pop(writer, None)
+            # a worker that went away gives back every slot it held
+            for lease in self.leases.values():
+                lease.waiters = deque(w for w in lease.waiters if w[0] is not writer)
+            for email, count in held.items():
+                for _ in range(count):
+                    self._release(email)
+            writer.close()
+
+    def _handle(self, message, writer, held):
+        op = message["op"]
+        if op == "lease":
+            self._lease(message, writer, held)
+        elif op == "lease_cancel":
+            self._cancel_lease(message, writer)
+        elif op == "release":
+            email = message["email"]
+            # slots leased before a coordinator restart are unknown here
+            if held.get(email, 0) > 0:
+                held[email] -= 1
+                self._release(email)
+        elif op == "breaker":
+            self.breakers[message["email"]] = message["state"]
+            for other in self.writers:
+                if other is not writer:
+                    other.write(encode(message))
+        elif op == "rate_limit" or op == "reload":
+            for other in self.writers:
+                if other is not writer:
+                    other.write(encode(message))
+        elif op == "session_get":
+            writer.write(encode({"id": message["id"], "row": self._get_session(*message["key"])}))
+        elif op == "session_put":
+            self._put_session(message["row"])
+        elif op == "session_remove":
+            for key in [key for key in self.sessions if key[1] == message["user_id"]]:
+                del self.sessions[key]
+        elif op == "metrics":
+            self.metrics[writer] = message["snapshot"]
+        elif op == "metrics_all":
+            # added up here, so a reply is as long as one snapshot whatever the number of workers
+            snapshots = [snapshot for other, snapshot in self.metrics.items() if other is not writer]
+            snapshots = [merge_snapshots(snapshots)] if snapshots else []
+            writer.write(encode({"id": message["id"], "snapshots": snapshots}))
+        elif op == "stats":
+            writer.write(encode({"id": message["id"], "stats": self.stats()}))
+        elif op == "token":
+            task = asyncio.create_task(self._token(message, writer))
+            self.tasks.add(task)
+            task.add_done_callback(self.tasks.discard)
+        elif op == "token_drop":
+            token = self.tokens.pop(message["email"], None)
+            if token is not None and token.renewer is not None:
+                token.renewer.cancel()
+
+    async def _token(self, message, writer):
+        """Reply the access token of an account, refreshed first when it is new or the worker found it stale."""
+        email = message["email"]
+        token = self.tokens.get(email)
+        if token is None:
+            token = self.tokens[email] = AccountToken(message["access_token"], message["refresh_token"])
+            await self._refresh(email)
+        elif token.access_token is None or token.access_token == message["stale"]:
+            await self._refresh(email)
+        elif token.refreshing is not None and not token.refreshing.done():
+            # the refresh under way brings the fresh token
+            await asyncio.shield(token.refreshing)
+        if token.renewer is None:
+            token.renewer = asyncio.create_task(self._renew_forever(email, token))
+        writer.write(encode({"id": message["id"], "access_token": token.access_token}))
+
+    async def _refresh(self, email):
+        # workers that raced the same expired token share a single refresh
+        token = self.tokens[email]
+        if token.refreshing is None or token.refreshing.done():
+            if time.monotonic() - token.refreshed_at < REFRESH_MIN_INTERVAL:
+                return
+            token.refreshing = asyncio.create_task(self._refresh_token(email, token))
+        await asyncio.shield(token.refreshing)
+
+    async def _refresh_token(self, email, token: AccountToken):
+        if self.client is None:
+            self.client = httpx.AsyncClient()
+        try:
+            access_token, refresh_token = await Credential.get_refreshed_token(
+                token.refresh_token, self.client
+            )
+            if access_token is None:
+                raise Exception("empty access token")
+        except Exception as e:
+            logging.error("[RefreshToken] refresh token failed: {}: {}".format(email, e))
+            return
+        token.access_token = access_token
+        token.refresh_token = refresh_token
+        token.refreshed_at = time.monotonic()
+        logging.info("[RefreshToken] access token refreshed: {}".format(email))
+        message = encode(
+            {"op": "token", "email": email, "access_token": access_token, "refresh_token": refresh_token}
+        )
+        for writer in self.writers:
+            writer.write(message)
+
+    async def _renew_forever(self, email, token: AccountToken):
+        while True:
+            expiry = Credential.get_token_expiry(token.access_token)
+            if expiry is None:
+                delay = RENEW_FALLBACK_INTERVAL
+            else:
+                delay = max(expiry - self.refresh_ahead - time.time(), RENEW_RETRY_INTERVAL)
+            await asyncio.sleep(delay)
+            await self._refresh(email)
+
+    def _lease(self, message, writer, held):
+        email = message["email"]
+        lease = self.leases.setdefault(email, Lease())
+        if lease.held < message["limit"] and len(lease.waiters) == 0:
+            lease.held += 1
+            held[email] = held.get(email, 0) + 1
+            writer.write(encode({"id": message["id"]}))
+            self._publish_held(email)
+        else:
+            lease.waiters.append((writer, message["id"], held, message["limit"]))
+
+    def _cancel_lease(self, message, writer):
+        lease = self.leases.get(message["email"])
+        if lease is None:
+            return
+        for waiter in lease.waiters:
+            if waiter[0] is writer and waiter[1] == message["lease"]:
+                lease.waiters.remove(waiter)
+                writer.write(encode({"id": message["lease"], "cancelled": True}))
+                return
+
+    def _release(self, email):
+        lease = self.leases[email]
+        lease.held -= 1
+        while lease.waiters and lease.held < lease.waiters[0][3]:
+            writer, request_id, waiter_held, _ = lease.waiters.popleft()
+            lease.held += 1
+            waiter_held[email] = waiter_held.get(email, 0) + 1
+            writer.write(encode({"id": request_id}))
+        self._publish_held(email)
+
+    def _publish_held(self, email):
+        # schedulers of every worker see the slots of the account held pool-wide
+        message = encode({"op": "held", "email": email, "held": self.leases[email].held})
+        for writer in self.writers:
+            writer.write(message)
+
+    def _get_session(self, model, user_id) -> Optional[list]:
+        row = self.sessions.get((model, user_id))
+        if row is None:
+            return None
+        if time.time() - row[5] > self.session_ttl:
+            del self.sessions[(model, user_id)]
+            return None
+        self.sessions.move_to_end((model, user_id))
+        return row
+
+    def _put_session(self, row):
+        key = (row[0], row[1])
+        self.sessions[key] = row
+        self.sessions.move_to_end(key)
+        while len(self.sessions) > self.max_sessions:
+            self.sessions.popitem(last=False)
+
+    def stats(self):
+        return {
+            "workers": len(self.writers),
+            "sessions": len(self.sessions),
+            "leases": {
+                email: {"held": lease.held, "waiting": len(lease.waiters)}
+                for email, lease in self.leases.items()
+            },
+            "breakers": dict(self.breakers),
+        }
+
+
+def run_coordinator(path, config):
+    """Entry point of the coordinator process."""
+    logging.basicConfig(
+        level=logging.INFO,
+        format="%(asctime)s %(message)s",
+        datefmt="%Y-%m-%d %H:%M:%S",
+    )
+    # the parent stops the coordinator once the workers have drained
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    asyncio.run(Coordinator.from_config(path, config).serve_forever())
+
+
+class CoordinatorClient:
+    """Connection of one worker to the coordinator, it reconnects when the coordinator restarts."""
+
+    def __init__(self, path, connect_timeout=10):
+        self.path = path
+        self.connect_timeout = connect_timeout
+        self.reader: Optional[asyncio.StreamReader] = None
+        self.writer: Optional[asyncio.StreamWriter] = None
+        self.ids = itertools.count()
+        self.pending: Dict[int, tuple] = {}
+        self.on_breaker: Optional[Callable[[str, dict], None]] = None
+        self.on_rate_limit: Optional[Callable[[list], None]] = None
+        self.on_reload: Optional[Callable[[], None]] = None
+        self.on_held: Optional[Callable[[str, int], None]] = None
+        self.on_token: Optional[Callable[[str, str, str], None]] = None
+        self.receiver = None
+        self.closing = False
+
+    async def _open(self):
+        self.reader, self.writer = await asyncio.open_unix_connection(
+            self.path, limit=MESSAGE_LIMIT
+        )
+        self.receiver = asyncio.create_task(self._receive())
+
+    async def connect(self):
+        deadline = time.monotonic() + self.connect_timeout
+        while True:
+            try:
+                await self._open()
+                return
+            except (ConnectionError, FileNotFoundError):
+                # the coordinator process may still be starting
+                if time.monotonic() > deadline:
+                    raise
+                await asyncio.sleep(0.1)
+
+    async def close(self):
+        self.closing = True
+        if self.receiver is not None:
+            self.receiver.cancel()
+        if self.writer is not None:
+            self.writer.close()
+
+    async def _receive(self):
+        try:
+            while True:
+                line = await self.reader.readline()
+                if not line:
+                    break
+                self._dispatch(json.loads(line))
+        except ConnectionError:
+            pass
+        except Exception as e:
+            logging.error("[Coordinator] bad message from the coordinator: {}".format(e))
+        if self.writer is not None:
+            # the coordinator frees the slots of this connection once it is closed
+            self.writer.close()
+        self.writer = None
+        for future, _ in self.pending.values():
+            if not future.done():
+                future.set_exception(ConnectionError("coordinator connection lost"))
+        self.pending.clear()
+        if not self.closing:
+            logging.error("[Coordinator] connection lost, reconnecting")
+            asyncio.create_task(self._reconnect())
+
+    async def _reconnect(self):
+        while not self.closing:
+            await asyncio.sleep(RECONNECT_INTERVAL)
+            try:
+                await self._open()
+                logging.info("[Coordinator] reconnected")
+                return
+            except (ConnectionError, FileNotFoundError):
+                continue
+
+    def _dispatch(self, message):
+        if "id" not in message:
+            if message["op"] == "breaker" and self.on_breaker is not None:
+                self.on_breaker(message["email"], message["state"])
+            elif message["op"] == "rate_limit" and self.on_rate_limit is not None:
+                self.on_rate_limit(message["takes"])
+            elif message["op"] == "reload" and self.on_reload is not None:
+                self.on_reload()
+            elif message["op"] == "held" and self.on_held is not None:
+                self.on_held(message["email"], message["held"])
+            elif message["op"] == "token" and self.on_token is not None:
+                self.on_token(message["email"], message["access_token"], message["refresh_token"])
+            return
+        future, lease_email = self.pending.pop(message["id"])
+        if message.get("cancelled"):
+            return
+        if future.cancelled():
+            if lease_email is not None:
+                # the waiter gave up before the slot was granted
+                self.release(lease_email)
+            return
+        future.set_result(message)
+
+    def _send(self, message):
+        if self.writer is None:
+            raise ConnectionError("coordinator not connected")
+        self.writer.write(encode(message))
+
+    async def _request(self, message, lease_email=None):
+        message["id"] = next(self.ids)
+        future = asyncio.get_running_loop().create_future()
+        self._send(message)
+        self.pending[message["id"]] = (future, lease_email)
+        return await future
+
+    async def lease(self, email, limit, timeout=None):
+        """Wait for a slot of ``email``, a slot granted after ``timeout`` is given back on arrival."""
+        message = {"op": "lease", "email": email, "limit": limit}
+        try:
+            await asyncio.wait_for(self._request(message, lease_email=email), timeout)
+        except (asyncio.TimeoutError, asyncio.CancelledError):
+            # leave the queue, unless the slot was granted meanwhile
+            if "id" in message:
+                try:
+                    self._send({"op": "lease_cancel", "email": email, "lease": message["id"]})
+                except ConnectionError:
+                    pass
+            raise
+
+    def release(self, email):
+        try:
+            self._send({"op": "release", "email": email})
+        except ConnectionError:
+            # the coordinator forgets the slots of a lost connection itself
+            pass
+
+    async def access_token(self, email, refresh_token, access_token, stale=None):
+        """
+        The access token the coordinator keeps for ``email``.
+
+        ``stale`` is the token the caller found expired, the coordinator
+        refreshes unless another worker already did.
+        """
+        reply = await self._request(
+            {
+                "op": "token",
+                "email": email,
+                "refresh_token": refresh_token,
+                "access_token": access_token,
+                "stale": stale,
+            }
+        )
+        return reply["access_token"]
+
+    def drop_token(self, email):
+        try:
+            self._send({"op": "token_drop", "email": email})
+        except ConnectionError:
+            pass
+
+    def publish_breaker(self, email, state):
+        try:
+            self._send({"op": "breaker", "email": email, "state": state})
+        except ConnectionError as e:
+            logging.warning("[Coordinator] breaker of {} not shared: {}".format(email, e))
+
+    def publish_rate_limit(self, takes):
+        try:
+            self._send({"op": "rate_limit", "takes": takes})
+        except ConnectionError:
+            # until it reconnects this worker only counts its own requests
+            pass
+
+    def publish_reload(self):
+        try:
+            self._send({"op": "reload"})
+        except ConnectionError as e:
+            logging.warning("[Coordinator] reload not sent to the other workers: {}".format(e))
+
+    async def get_session(self, model, user_id, timeout=1.0) -> Optional[list]:
+        try:
+            reply = await asyncio.wait_for(
+                self._request({"op": "session_get", "key": [model, user_id]}), timeout
+            )
+        except asyncio.TimeoutError:
+            raise ConnectionError("coordinator did not answer in {}s".format(timeout))
+        return reply["row"]
+
+    def put_session(self, row):
+        try:
+            self._send({"op": "session_put", "row": row})
+        except ConnectionError:
+            pass
+
+    def remove_sessions(self, user_id):
+        try:
+            self._send({"op": "session_remove", "user_id": user_id})
+        except ConnectionError:
+            pass
+
+    def push_metrics(self, snapshot):
+        try:
+            self._send({"op": "metrics", "snapshot": snapshot})
+        except ConnectionError:
+            pass
+
+    async def metrics(self):
+        """The sum of the metrics snapshots last pushed by the other workers."""
+        reply = await self._request({"op": "metrics_all"})
+        return reply["snapshots"]
+
+    async def stats(self):
+        reply = await self._request({"op": "stats"})
+        return reply["stats"]
@@ -1,9 +1,29 @@
 import asyncio
+import base64
+import copy
+import hashlib
+import json
 import logging
+import time
+from contextlib import asynccontextmanager
 
 import httpx
 from ChatGPT2API.V1 import AsyncChatbot as ChatGPTBot
 
+from .admission import AdmissionRejected
+from .breaker import CircuitBreaker
+from .metrics import on_upstream_response
+
+# url = "https://auth0.openai.com/oauth/token"
+REFRESH_URL = "https://ai.fakeopen.com/auth/session"
+REFRESH_HEADERS = {
+    "Content-Type": "application/x-www-form-urlencoded",
+}
+# failures of requests that raced the same expired token must not refresh again
+REFRESH_MIN_INTERVAL = 30
+RENEW_RETRY_INTERVAL = 60
+RENEW_FALLBACK_INTERVAL = 60 * 60 * 24
+
 
 class Credential:
     def __init__(
@@ -14,65 +34,323 @@ class Credential:
         refresh_token=None,
         conversation_id=None,
         verbose=False,
+        concurrency=1,
     ):
         self.email = email
+        # names the account in metrics without exposing the email
+        self.label = hashlib.sha1(email.encode()).hexdigest()[:8]
         self.password = password
         self.conversation_id = conversation_id
-        self.lock = None
+        self.concurrency = concurrency
+        self.slots = None
+        self.in_flight = 0
+        # slots held by every worker, as last told by the coordinator
+        self.pool_in_flight = 0
+        self.waiting = 0
+        self.ewma_latency = None
+        self.breaker = CircuitBreaker(name=email, on_change=self._notify)
+        self.listeners = []
+        self.coordinator = None
+        self.lease_timeout = None
+        self.transport = None
+        self.rate_limiter = None
+        # removed from the pool by a reload
+        self.retired = False
+        self.refreshing = None
+        self.refreshed_at = float("-inf")
+        self.renewer = None
         self.verbose = verbose
         self.refresh_token = refresh_token
-        logging.info("[Credential] init: {}".format(email))
-        if refresh_token is not None:
-            self.refresh_access_token()
-        else:
-            self.chat_gpt_bot = ChatGPTBot(
-                config={
-                    "email": email,
-                    "password": password,
-                    "access_token": access_token,
-                    "verbose": verbose,
-                },
-                conversation_id=conversation_id,
+        self.initial_access_token = access_token
+        self.chat_gpt_bot = None
+        self.init_time = None
+
+    async def init(self):
+        """Log in the account, building the bot does blocking io so it runs in an executor."""
+        logging.info("[Credential] init: {}".format(self.email))
+        start_time = time.monotonic()
+        if self.refresh_token is not None:
+            await self.refresh_access_token()
+        # accounts whose refresh failed fall back to the access token they were given
+        if self.chat_gpt_bot is None and (
+            self.refresh_token is None or self.initial_access_token is not None
+        ):
+            loop = asyncio.get_running_loop()
+            self.chat_gpt_bot = await loop.run_in_executor(
+                None, self._new_account_bot, self.initial_access_token
             )
+        if self.chat_gpt_bot is None:
+            raise Exception("failed to init credential: {}".format(self.email))
+        self.init_time = time.monotonic() - start_time
+        logging.info(
+            "[Credential] init done: {} in {:.2f}s".format(self.email, self.init_time)
+        )
 
     def set_verbose(self, verbose):
         self.verbose = verbose
-        self.chat_gpt_bot.verbose = verbose
+        if self.chat_gpt_bot is not None:
+            self.chat_gpt_bot.verbose = verbose
+
+    def set_concurrency(self, concurrency):
+        # slots are created lazily on the running loop, so only the size is kept here
+        self.concurrency = max(1, int(concurrency))
+        self.slots = None
+
+    @asynccontextmanager
+    async def acquire(self):
+        """Hold one concurrency slot of this account and yield a per-request bot."""
+        if self.slots is None:
+            self.slots = asyncio.Semaphore(self.concurrency)
+        self.waiting += 1
+        leased = False
+        try:
+            await self.slots.acquire()
+            if self.coordinator is not None:
+                # the same slot may not be used by another worker process
+                try:
+                    await self.coordinator.lease(self.email, self.concurrency, self.lease_timeout)
+                    leased = True
+                except asyncio.TimeoutError:
+                    self.slots.release()
+                    retry_after = max(1, int(self.lease_timeout or 0))
+                    logging.warning("[Credential] no slot of {} freed in time".format(self.email))
+                    raise AdmissionRejected(
+                        "😱 机器人负载过多，请{}秒后再试(The robot is overwhelmed, please retry after {}s)".format(
+                            retry_after, retry_after
+                        ),
+                        retry_after,
+                    )
+                except ConnectionError as e:
+                    # until the coordinator is back only the local slots bound this worker
+                    logging.warning("[Credential] no lease for {}: {}".format(self.email, e))
+                except BaseException:
+                    self.slots.release()
+                    raise
+        finally:
+            self.waiting -= 1
+        self.breaker.on_acquire()
+        if self.rate_limiter is not None:
+            self.rate_limiter.take_credential(self.email)
+        self.in_flight += 1
+        self._notify()
+        try:
+            yield self.new_chat_gpt_bot()
+        finally:
+            self.in_flight -= 1
+            self.breaker.on_release()
+            if leased:
+                self.coordinator.release(self.email)
+            self.slots.release()
+            self._notify()
+
+    def load(self):
+        """Slots in use, counting the ones other workers hold."""
+        return max(self.in_flight, self.pool_in_flight)
+
+    def is_busy(self):
+        return self.load() >= self.concurrency
+
+    def set_pool_in_flight(self, held):
+        self.pool_in_flight = held
+        self._notify()
+
+    def observe_latency(self, latency, alpha=0.3):
+        if self.ewma_latency is None:
+            self.ewma_latency = latency
+        else:
+            self.ewma_latency = alpha * latency + (1 - alpha) * self.ewma_latency
+        self._notify()
+
+    def set_breaker(self, failure_threshold=3, cooldown=60, max_cooldown=900):
+        self.breaker = CircuitBreaker(
+            name=self.email,
+            failure_threshold=failure_threshold,
+            cooldown=cooldown,
+            max_cooldown=max_cooldown,
+            on_change=self._notify,
+        )
+
+    def is_available(self):
+        return not self.retired and self.breaker.available() and self.quota_wait() == 0
+
+    def quota_wait(self):
+        """Seconds until the rate limit of this account allows another request."""
+        if self.rate_limiter is None:
+            return 0.0
+        return self.rate_limiter.credential_wait(self.email)
+
+    def set_coordinator(self, coordinator, lease_timeout=None):
+        self.coordinator = coordinator
+        self.lease_timeout = lease_timeout
+
+    def set_transport(self, transport):
+        self.transport = transport
+
+    def set_rate_limiter(self, rate_limiter):
+        self.rate_limiter = rate_limiter
+
+    def record_success(self):
+        opened = self.breaker.opened
+        self.breaker.record_success()
+        if opened:
+            self._share_breaker()
 
-    def refresh_access_token(self):
+    def record_failure(self, rate_limited=False):
+        opened_until = self.breaker.opened_until
+        self.breaker.record_failure(rate_limited=rate_limited)
+        if self.breaker.opened_until != opened_until:
+            self._share_breaker()
+
+    def _share_breaker(self):
+        if self.coordinator is not None:
+            self.coordinator.publish_breaker(self.email, self.breaker.share())
+
+    def add_listener(self, listener):
+        self.listeners.append(listener)
+
+    def _notify(self):
+        for listener in self.listeners:
+            listener(self)
+
+    def new_chat_gpt_bot(self):
+        # shallow copy shares the http client of the account bot, but the
+        # conversation and model state stay private to a single request
+        bot = copy.copy(self.chat_gpt_bot)
+        bot.config = dict(self.chat_gpt_bot.config)
+        bot.conversation_id = None
+        bot.parent_id = None
+        bot.conversation_id_prev_queue = []
+        bot.parent_id_prev_queue = []
+        return bot
+
+    def _new_account_bot(self, access_token):
+        bot = ChatGPTBot(
+            config={
+                "email": self.email,
+                "password": self.password,
+                "access_token": access_token,
+                "verbose": self.verbose,
+            },
+            conversation_id=self.conversation_id,
+        )
+        if self.transport is not None:
+            # keep the headers of the account, connections come from the shared pool
+            bot.session = self.transport.client(headers=bot.session.headers)
+        hooks = bot.session.event_hooks
+        hooks["response"].append(on_upstream_response)
+        bot.session.event_hooks = hooks
+        return bot
+
+    def request_refresh(self):
+        """Start a refresh in the background without waiting for it."""
         if not self.refresh_token:
-            return
+            return None
+        if self.refreshing is None or self.refreshing.done():
+            if time.monotonic() - self.refreshed_at < REFRESH_MIN_INTERVAL:
+                return None
+            self.refreshing = asyncio.create_task(self._refresh_access_token())
+        return self.refreshing
+
+    async def refresh_access_token(self):
+        """Refresh the access token, concurrent callers share a single refresh."""
+        task = self.request_refresh()
+        if task is not None:
+            await asyncio.shield(task)
+
+    async def _refresh_access_token(self):
         try:
-            access_token, new_refresh_token = Credential.get_refreshed_token(
-                self.refresh_token
-            )
+            if self.coordinator is not None:
+                # one process refreshes for every worker, it keeps the rotated refresh token
+                access_token = await self.coordinator.access_token(
+                    self.email, self.refresh_token, self.initial_access_token, self.current_access_token()
+                )
+            else:
+                access_token, self.refresh_token = await Credential.get_refreshed_token(
+                    self.refresh_token,
+                    self.transport.shared_client() if self.transport is not None else None,
+                )
             if access_token is None:
                 raise Exception("empty access token")
-            self.refresh_token = new_refresh_token
-            self.chat_gpt_bot = ChatGPTBot(
-                config={
-                    "email": self.email,
-                    "password": self.password,
-                    "access_token": access_token,
-                    "verbose": self.verbose,
-                },
-                conversation_id=self.conversation_id,
-            )
+            if access_token == self.current_access_token():
+                return
+            if self.chat_gpt_bot is None:
+                # building a bot does blocking io, keep it off the event loop
+                loop = asyncio.get_running_loop()
+                self.chat_gpt_bot = await loop.run_in_executor(
+                    None, self._new_account_bot, access_token
+                )
+            else:
+                # in-flight requests share this client, they keep the headers
+                # they were sent with and new requests pick up the new token
+                self._use_access_token(access_token)
+            self.refreshed_at = time.monotonic()
             logging.info("[RefreshToken] access token refreshed: {}".format(self.email))
         except Exception as e:
             logging.error("[RefreshToken] refresh token failed:" + str(e))
 
+    def apply_refreshed_token(self, access_token, refresh_token):
+        """Take a token another process refreshed, accounts still logging in ask for it themselves."""
+        self.refresh_token = refresh_token
+        if self.chat_gpt_bot is not None and access_token != self.current_access_token():
+            self._use_access_token(access_token)
+            self.refreshed_at = time.monotonic()
+
+    def _use_access_token(self, access_token):
+        # the set_access_token of the bot writes its token cache file on the
+        # event loop and clears the other headers, PUID among them
+        self.chat_gpt_bot.session.headers.update(
+            {
+                "Authorization": "Bearer {}".format(access_token),
+                "X-Authorization": "Bearer {}".format(access_token),
+            }
+        )
+        self.chat_gpt_bot.config["access_token"] = access_token
+
+    def start_renewer(self, ahead=600):
+        # with several workers the coordinator renews the tokens of all of them
+        if self.refresh_token and self.renewer is None and self.coordinator is None:
+            self.renewer = asyncio.create_task(self._renew_forever(ahead))
+
+    def stop_renewer(self):
+        if self.renewer is not None:
+            self.renewer.cancel()
+            self.renewer = None
+
+    async def _renew_forever(self, ahead):
+        while True:
+            expiry = Credential.get_token_expiry(self.current_access_token())
+            if expiry is None:
+                delay = RENEW_FALLBACK_INTERVAL
+            else:
+                delay = max(expiry - ahead - time.time(), RENEW_RETRY_INTERVAL)
+            await asyncio.sleep(delay)
+            await self.refresh_access_token()
+
+    def current_access_token(self):
+        if self.chat_gpt_bot is None:
+            return None
+        return self.chat_gpt_bot.config.get("access_token")
+
+    @staticmethod
+    def get_token_expiry(access_token):
+        """Read the ``exp`` claim of a jwt access token without verifying it."""
+        if not access_token:
+            return None
+        try:
+            payload = access_token.split(".")[1]
+            payload += "=" * (-len(payload) % 4)
+            return float(json.loads(base64.urlsafe_b64decode(payload))["exp"])
+        except Exception as _:
+            return None
+
     @staticmethod
-    def get_refreshed_token(refresh_token):
-        # url = "https://auth0.openai.com/oauth/token"
-        url = "https://ai.fakeopen.com/auth/session"
-        headers = {
-            "Content-Type": "application/x-www-form-urlencoded",
-        }
-        data = {
-            "session_token": refresh_token,
-        }
-        r = httpx.post(url, data=data, headers=headers)
+    async def get_refreshed_token(refresh_token, client: httpx.AsyncClient = None):
+        if client is None:
+            async with httpx.AsyncClient() as client:
+                return await Credential.get_refreshed_token(refresh_token, client)
+        r = await client.post(
+            REFRESH_URL, data={"session_token": refresh_token}, headers=REFRESH_HEADERS
+        )
         body = r.json()
         access_token = body["access_token"]
         new_session_token = body["session_token"]
@@ -0,0 +1,40 @@
+class StreamDelta:
+    """
+    Turn the cumulative messages of an upstream stream into the new text only.
+
+    Each upstream event carries the whole answer so far. Only the part past
+    what was already emitted is sliced off, and continuity is checked against
+    a short tail window instead of the full prefix, so the work over a stream
+    is linear in the answer length. The full answer is never rebuilt from the
+    deltas, the latest upstream text is kept by reference instead.
+
+    Upstream occasionally rewrites text it already sent. Emitted deltas can
+    not be taken back from a client, so the stream continues from the emitted
+    length and the rewrite is counted, while ``text`` follows upstream.
+    """
+
+    __slots__ = ("window", "emitted", "tail", "text", "rewrites")
+
+    def __init__(self, window=8):
+        self.window = window
+        self.emitted = 0
+        self.tail = ""
+        self.text = ""
+        self.rewrites = 0
+
+    def feed(self, text: str) -> str:
+        if not text:
+            return ""
+        emitted = self.emitted
+        size = len(text)
+        if size <= emitted:
+            if size < emitted:
+                self.rewrites += 1
+                self.text = text
+            return ""
+        if not text.startswith(self.tail, emitted - len(self.tail)):
+            self.rewrites += 1
+        self.text = text
+        self.emitted = size
+        self.tail = text[size - self.window :] if size > self.window else text
+        return text[emitted:]
@@ -0,0 +1,101 @@
+from collections import deque
+
+
+def percentile(values, q):
+    if len(values) == 0:
+        return None
+    ordered = sorted(values)
+    return ordered[min(int(q * len(ordered)), len(ordered) - 1)]
+
+
+class HedgePolicy:
+    """
+    Decide when a second attempt is started for a slow first token.
+
+    The delay is the ``percentile`` of recent time to first token samples of
+    first attempts, so only the slow tail gets hedged. A first attempt that lost
+    to its hedge is sampled with the time it waited, a lower bound, so hedges
+    that win do not pull the delay down. ``initial_delay`` is used until
+    ``min_samples`` were seen.
+    """
+
+    def __init__(
+        self,
+        enabled=False,
+        percentile=0.9,
+        min_delay=1.0,
+        initial_delay=5.0,
+        min_samples=20,
+        window=256,
+    ):
+        self.enabled = enabled
+        self.percentile = percentile
+        self.min_delay = min_delay
+        self.initial_delay = initial_delay
+        self.min_samples = min_samples
+        self.samples = deque(maxlen=window)
+        self.cached_delay = None
+        self.recorded = 0
+        self.requests = 0
+        self.hedged = 0
+        self.hedge_wins = 0
+        # time to first token seen by clients, and an estimate of what it
+        # would have been without hedging
+        self.ttft = deque(maxlen=window)
+        self.unhedged_ttft = deque(maxlen=window)
+
+    @staticmethod
+    def from_config(config) -> "HedgePolicy":
+        hedge_config = config["engine"]["chatgpt"].get("hedging", {}) or {}
+        return HedgePolicy(
+            enabled=hedge_config.get("enabled", False),
+            percentile=hedge_config.get("percentile", 0.9),
+            min_delay=hedge_config.get("minDelay", 1.0),
+            initial_delay=hedge_config.get("initialDelay", 5.0),
+        )
+
+    def delay(self):
+        if len(self.samples) < self.min_samples:
+            return self.initial_delay
+        if self.cached_delay is None:
+            self.cached_delay = max(
+                percentile(self.samples, self.percentile), self.min_delay
+            )
+        return self.cached_delay
+
+    def record_attempt(self, ttft):
+        self.samples.append(ttft)
+        self.recorded += 1
+        if self.recorded % 16 == 0:
+            self.cached_delay = None
+
+    def estimate_beyond(self, elapsed):
+        """Median of the samples slower than ``elapsed``, the expected ttft of a cancelled attempt."""
+        slower = [sample for sample in self.samples if sample > elapsed]
+        if len(slower) == 0:
+            return elapsed
+        return percentile(slower, 0.5)
+
+    def record_request(self, ttft, unhedged_ttft, hedged, hedge_won):
+        self.requests += 1
+        self.ttft.append(ttft)
+        self.unhedged_ttft.append(unhedged_ttft)
+        if hedged:
+            self.hedged += 1
+        if hedge_won:
+            self.hedge_wins += 1
+
+    def snapshot(self):
+        p99 = percentile(self.ttft, 0.99)
+        unhedged_p99 = percentile(self.unhedged_ttft, 0.99)
+        return {
+            "enabled": self.enabled,
+            "delay": self.delay(),
+            "requests": self.requests,
+            "hedged": self.hedged,
+            "hedge_rate": self.hedged / self.requests if self.requests else 0,
+            "hedge_wins": self.hedge_wins,
+            "ttft_p99": p99,
+            "unhedged_ttft_p99": unhedged_p99,
+            "p99_improvement": unhedged_p99 - p99 if p99 is not None else None,
+        }
@@ -0,0 +1,160 @@
+from bisect import bisect_left
+from contextvars import ContextVar
+from typing import Callable, Dict, List, Optional
+
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120)
+
+# called by the http client once upstream response headers arrive, set per request
+upstream_response: ContextVar[Optional[Callable[[], None]]] = ContextVar(
+    "upstream_response", default=None
+)
+
+
+async def on_upstream_response(_):
+    callback = upstream_response.get()
+    if callback is not None:
+        callback()
+
+
+class Counter:
+    __slots__ = ("name", "help", "labels", "series")
+
+    def __init__(self, name, help, labels=()):
+        self.name = name
+        self.help = help
+        self.labels = labels
+        self.series: Dict[tuple, float] = {}
+
+    def inc(self, labels=(), amount=1):
+        self.series[labels] = self.series.get(labels, 0) + amount
+
+    def collect(self):
+        return self.series
+
+
+class Gauge:
+    """Read when metrics are collected, so setting it costs nothing on the request path."""
+
+    __slots__ = ("name", "help", "labels", "read")
+
+    def __init__(self, name, help, labels, read: Callable[[], Dict[tuple, float]]):
+        self.name = name
+        self.help = help
+        self.labels = labels
+        self.read = read
+
+    def collect(self):
+        return self.read()
+
+
+class Histogram:
+    __slots__ = ("name", "help", "labels", "buckets", "series")
+
+    def __init__(self, name, help, labels=(), buckets=DEFAULT_BUCKETS):
+        self.name = name
+        self.help = help
+        self.labels = labels
+        self.buckets = buckets
+        # per label values: a count per bucket, then +Inf, the sum and the count
+        self.series: Dict[tuple, List[float]] = {}
+
+    def observe(self, labels, value):
+        series = self.series.get(labels)
+        if series is None:
+            series = self.series[labels] = [0] * (len(self.buckets) + 3)
+        series[bisect_left(self.buckets, value)] += 1
+        series[-2] += value
+        series[-1] += 1
+
+    def collect(self):
+        return self.series
+
+
+class MetricsRegistry:
+    """
+    Metrics in the prometheus text format.
+
+    ``snapshot`` gives a json-able copy, snapshots of several worker
+    processes are added together by ``render``.
+    """
+
+    def __init__(self):
+        self.metrics = []
+
+    def counter(self, name, help, labels=()) -> Counter:
+        metric = Counter(name, help, labels)
+        self.metrics.append(metric)
+        return metric
+
+    def gauge(self, name, help, labels, read) -> Gauge:
+        metric = Gauge(name, help, labels, read)
+        self.metrics.append(metric)
+        return metric
+
+    def histogram(self, name, help, labels=(), buckets=DEFAULT_BUCKETS) -> Histogram:
+        metric = Histogram(name, help, labels, buckets)
+        self.metrics.append(metric)
+        return metric
+
+    def snapshot(self):
+        return {
+            metric.name: [[list(labels), value] for labels, value in metric.collect().items()]
+            for metric in self.metrics
+        }
+
+    def render(self, snapshots) -> str:
+        merged = merge_snapshots(snapshots)
+        lines = []
+        for metric in self.metrics:
+            kind = type(metric).__name__.lower()
+            lines.append("# HELP {} {}".format(metric.name, metric.help))
+            lines.append("# TYPE {} {}".format(metric.name, kind))
+            for labels, value in merged.get(metric.name, []):
+                pairs = list(zip(metric.labels, labels))
+                if kind != "histogram":
+                    lines.append("{}{} {}".format(metric.name, format_labels(pairs), value))
+                    continue
+                cumulative = 0
+                for bound, count in zip(metric.buckets + ("+Inf",), value):
+                    cumulative += count
+                    lines.append(
+                        "{}_bucket{} {}".format(
+                            metric.name, format_labels(pairs + [("le", bound)]), cumulative
+                        )
+                    )
+                lines.append("{}_sum{} {}".format(metric.name, format_labels(pairs), value[-2]))
+                lines.append("{}_count{} {}".format(metric.name, format_labels(pairs), value[-1]))
+        lines.append("")
+        return "\n".join(lines)
+
+
+def merge_snapshots(snapshots):
+    """Add up snapshots series by series, the result is a snapshot again."""
+    merged: Dict[str, Dict[tuple, object]] = {}
+    for snapshot in snapshots:
+        for name, series in snapshot.items():
+            metric = merged.setdefault(name, {})
+            for labels, value in series:
+                labels = tuple(labels)
+                if labels not in metric:
+                    metric[labels] = list(value) if isinstance(value, list) else value
+                elif isinstance(value, list):
+                    metric[labels] = [a + b for a, b in zip(metric[labels], value)]
+                else:
+                    metric[labels] += value
+    return {
+        name: [[list(labels), value] for labels, value in metric.items()]
+        for name, metric in merged.items()
+    }
+
+
+def format_labels(pairs):
+    if len(pairs) == 0:
+        return ""
+    return "{" + ",".join(
+        '{}="{}"'.format(
+            name,
+            str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n"),
+        )
+        for name, value in pairs
+    ) + "}"
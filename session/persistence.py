@@ -0,0 +1,200 @@
+import asyncio
+import logging
+import sqlite3
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, List, Optional, Tuple
+
+from .user_session import UserSession
+
+CREATE_TABLE = """
+CREATE TABLE IF NOT EXISTS engine_user_session (
+    model TEXT NOT NULL,
+    user_id TEXT NOT NULL,
+    conversation_id TEXT,
+    parent_id TEXT,
+    email TEXT,
+    last_time REAL NOT NULL,
+    PRIMARY KEY (model, user_id)
+)
+"""
+CREATE_INDEX = """
+CREATE INDEX IF NOT EXISTS engine_user_session_last_time
+ON engine_user_session (last_time)
+"""
+UPSERT = """
+INSERT INTO engine_user_session (model, user_id, conversation_id, parent_id, email, last_time)
+VALUES (?, ?, ?, ?, ?, ?)
+ON CONFLICT (model, user_id) DO UPDATE SET
+    conversation_id = excluded.conversation_id,
+    parent_id = excluded.parent_id,
+    email = excluded.email,
+    last_time = excluded.last_time
+"""
+DELETE = "DELETE FROM engine_user_session WHERE model = ? AND user_id = ?"
+SELECT_ONE = """
+SELECT model, user_id, conversation_id, parent_id, email, last_time
+FROM engine_user_session WHERE model = ? AND user_id = ? AND last_time > ?
+"""
+SELECT_RECENT = """
+SELECT model, user_id, conversation_id, parent_id, email, last_time
+FROM engine_user_session WHERE last_time > ? ORDER BY last_time DESC LIMIT ?
+"""
+PRUNE = "DELETE FROM engine_user_session WHERE last_time <= ?"
+
+Row = Tuple[str, str, Optional[str], Optional[str], Optional[str], float]
+
+
+class SessionPersistence:
+    """
+    Write-behind sqlite store of user sessions.
+
+    The request path only records the latest state of a session in memory,
+    a background task writes the changes in batches on a dedicated thread, so
+    requests never wait on disk. Sessions are read back at startup (most
+    recent first) and lazily on a cache miss.
+    """
+
+    def __init__(self, path=None, flush_interval=1.0, batch_size=500, ttl=86400, enabled=True):
+        self.path = path
+        self.flush_interval = flush_interval
+        self.batch_size = batch_size
+        self.ttl = ttl
+        self.enabled = enabled and path is not None
+        self.dirty: Dict[Tuple[str, str], Optional[Row]] = {}
+        self.connection = None
+        self.executor = None
+        self.flusher = None
+        self.wakeup = None
+        self.written = 0
+        self.flushes = 0
+        self.loaded = 0
+
+    @staticmethod
+    def from_config(config) -> "SessionPersistence":
+        store_config = config["engine"].get("session", {}) or {}
+        database = config.get("database") or {}
+        if not store_config.get("persist", False):
+            return SessionPersistence(enabled=False)
+        if database.get("type") != "sqlite":
+            logging.warning("[Persistence] only sqlite is supported, sessions are kept in memory")
+            return SessionPersistence(enabled=False)
+        return SessionPersistence(
+            path=database.get("path"),
+            flush_interval=store_config.get("flushInterval", 1.0),
+            batch_size=store_config.get("flushBatch", 500),
+            ttl=store_config.get("ttl", 86400),
+        )
+
+    async def _run(self, fn, *args):
+        return await asyncio.get_running_loop().run_in_executor(self.executor, fn, *args)
+
+    def _open(self):
+        self.connection = sqlite3.connect(self.path, check_same_thread=False)
+        self.connection.execute("PRAGMA journal_mode=WAL")
+        self.connection.execute("PRAGMA synchronous=NORMAL")
+        self.connection.execute(CREATE_TABLE)
+        self.connection.execute(CREATE_INDEX)
+        self.connection.commit()
+
+    async def start(self):
+        if not self.enabled:
+            return
+        # sqlite connections are used from the single thread that created them
+        self.executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="session-db")
+        await self._run(self._open)
+        self.wakeup = asyncio.Event()
+        self.flusher = asyncio.create_task(self._flush_forever())
+
+    async def stop(self):
+        if not self.enabled or self.flusher is None:
+            return
+        self.flusher.cancel()
+        self.flusher = None
+        await self.flush()
+        await self._run(self.connection.close)
+        self.executor.shutdown(wait=False)
+
+    def save(self, model, user_id, session: UserSession):
+        if not self.enabled:
+            return
+        self.dirty[(model, user_id)] = session.row(model)
+        if len(self.dirty) >= self.batch_size and self.wakeup is not None:
+            self.wakeup.set()
+
+    def delete(self, model, user_id):
+        if not self.enabled:
+            return
+        self.dirty[(model, user_id)] = None
+
+    def _write(self, upserts: List[Row], deletes: List[Tuple[str, str]], prune_before):
+        with self.connection:
+            if upserts:
+                self.connection.executemany(UPSERT, upserts)
+            if deletes:
+                self.connection.executemany(DELETE, deletes)
+            if prune_before is not None:
+                self.connection.execute(PRUNE, (prune_before,))
+
+    async def flush(self, prune=False):
+        if not self.enabled or (len(self.dirty) == 0 and not prune):
+            return
+        dirty, self.dirty = self.dirty, {}
+        upserts = [row for row in dirty.values() if row is not None]
+        deletes = [key for key, row in dirty.items() if row is None]
+        prune_before = time.time() - self.ttl if prune else None
+        try:
+            await self._run(self._write, upserts, deletes, prune_before)
+        except Exception as e:
+            logging.error("[Persistence] flush failed: {}".format(e))
+            # keep the changes for the next flush unless newer ones arrived
+            for key, row in dirty.items():
+                self.dirty.setdefault(key, row)
+            return
+        self.written += len(dirty)
+        self.flushes += 1
+
+    async def _flush_forever(self):
+        last_prune = time.monotonic()
+        while True:
+            try:
+                await asyncio.wait_for(self.wakeup.wait(), timeout=self.flush_interval)
+            except asyncio.TimeoutError:
+                pass
+            self.wakeup.clear()
+            prune = time.monotonic() - last_prune > 3600
+            if prune:
+                last_prune = time.monotonic()
+            await self.flush(prune=prune)
+
+    def _select(self, query, args) -> List[Row]:
+        return self.connection.execute(query, args).fetchall()
+
+    async def load(self, model, user_id) -> Optional[Row]:
+        if not self.enabled:
+            return None
+        key = (model, user_id)
+        if key in self.dirty:
+            # not written yet, memory is newer than the database
+            return self.dirty[key]
+        rows = await self._run(self._select, SELECT_ONE, (model, user_id, time.time() - self.ttl))
+        if len(rows) == 0:
+            return None
+        self.loaded += 1
+        return rows[0]
+
+    async def load_recent(self, limit) -> List[Row]:
+        if not self.enabled:
+            return []
+        rows = await self._run(self._select, SELECT_RECENT, (time.time() - self.ttl, limit))
+        self.loaded += len(rows)
+        return rows
+
+    def stats(self):
+        return {
+            "enabled": self.enabled,
+            "dirty": len(self.dirty),
+            "written": self.written,
+            "flushes": self.flushes,
+            "loaded": self.loaded,
+        }
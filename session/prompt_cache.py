@@ -0,0 +1,156 @@
+import asyncio
+import logging
+import time
+from collections import OrderedDict
+from typing import AsyncGenerator, Callable, Dict, List, Optional
+
+from .metrics import Counter
+
+
+class Flight:
+    """One upstream answer shared by every request that asked the same prompt meanwhile."""
+
+    __slots__ = ("chunks", "done", "error", "changed", "subscribers", "task")
+
+    def __init__(self):
+        self.chunks: List[str] = []
+        self.done = False
+        self.error: Optional[BaseException] = None
+        self.changed = asyncio.Event()
+        self.subscribers = 0
+        self.task: Optional[asyncio.Task] = None
+
+    def _notify(self):
+        self.changed.set()
+        self.changed = asyncio.Event()
+
+    async def follow(self) -> AsyncGenerator[str, None]:
+        """Yield the answer from the start, late joiners first get what was already streamed."""
+        index = 0
+        while True:
+            while index < len(self.chunks):
+                index += 1
+                yield self.chunks[index - 1]
+            if self.done:
+                if self.error is not None:
+                    raise self.error
+                return
+            await self.changed.wait()
+
+
+class PromptCache:
+    """
+    Single-flight and a short lived cache for prompts without conversation context.
+
+    Requests for the same (model, sentence) while one is answered upstream
+    follow that answer instead of taking another account slot. Finished
+    answers are kept for ``ttl`` seconds, the least recently used are evicted
+    beyond ``max_size``.
+    """
+
+    def __init__(self, results: Counter = None, max_size=1000, ttl=300, enabled=True):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.enabled = enabled
+        self.results = results if results is not None else Counter("", "", ("result",))
+        self.answers: "OrderedDict[tuple, tuple]" = OrderedDict()
+        self.flights: Dict[tuple, Flight] = {}
+
+    @staticmethod
+    def from_config(results: Counter, config) -> "PromptCache":
+        cache_config = config["engine"].get("promptCache")
+        if cache_config is None:
+            return PromptCache(results, enabled=False)
+        return PromptCache(
+            results,
+            max_size=cache_config.get("maxSize", 1000),
+            ttl=cache_config.get("ttl", 300),
+            enabled=cache_config.get("enabled", True),
+        )
+
+    def _cached(self, key) -> Optional[str]:
+        entry = self.answers.get(key)
+        if entry is None:
+            return None
+        answer, expires_at = entry
+        if time.monotonic() > expires_at:
+            del self.answers[key]
+            return None
+        self.answers.move_to_end(key)
+        return answer
+
+    def _store(self, key, answer):
+        self.answers[key] = (answer, time.monotonic() + self.ttl)
+        self.answers.move_to_end(key)
+        while len(self.answers) > self.max_size:
+            self.answers.popitem(last=False)
+
+    async def _fly(self, key, flight: Flight, stream: AsyncGenerator[str, None]):
+        try:
+            async for message in stream:
+                flight.chunks.append(message)
+                flight._notify()
+            answer = "".join(flight.chunks)
+            if len(answer) == 0:
+                # like an answer of a conversation, an empty one is an error and never cached
+                raise Exception("empty response")
+            self._store(key, answer)
+        except asyncio.CancelledError:
+            flight.error = Exception("answer cancelled")
+            raise
+        except Exception as e:
+            flight.error = e
+        finally:
+            await stream.aclose()
+            flight.done = True
+            flight._notify()
+            self.flights.pop(key, None)
+
+    async def stream(
+        self, model, sentence, open_stream: Callable[[], AsyncGenerator[str, None]]
+    ) -> AsyncGenerator[str, None]:
+        key = (model, sentence)
+        answer = self._cached(key)
+        if answer is not None:
+            self.results.inc(("hit",))
+            yield answer
+            return
+        flight = self.flights.get(key)
+        if flight is None:
+            self.results.inc(("miss",))
+            flight = self.flights[key] = Flight()
+            # the upstream call belongs to no single client, it outlives the
+            # one that started it while others still follow
+            flight.task = asyncio.create_task(self._fly(key, flight, open_stream()))
+        else:
+            self.results.inc(("join",))
+            logging.info("[PromptCache] join in-flight answer, followers: {}".format(flight.subscribers + 1))
+        flight.subscribers += 1
+        try:
+            async for message in flight.follow():
+                yield message
+        finally:
+            flight.subscribers -= 1
+            if flight.subscribers == 0 and not flight.done:
+                flight.task.cancel()
+
+    async def ask(self, model, sentence, open_stream: Callable[[], AsyncGenerator[str, None]]) -> str:
+        chunks = []
+        stream = self.stream(model, sentence, open_stream)
+        try:
+            async for message in stream:
+                chunks.append(message)
+        finally:
+            await stream.aclose()
+        return "".join(chunks)
+
+    def snapshot(self):
+        results = {labels[0]: count for labels, count in self.results.series.items()}
+        total = sum(results.values())
+        return {
+            "enabled": self.enabled,
+            "size": len(self.answers),
+            "in_flight": len(self.flights),
+            "results": results,
+            "hit_rate": (results.get("hit", 0) + results.get("join", 0)) / total if total else 0,
+        }
@@ -0,0 +1,183 @@
+import logging
+import math
+import time
+from collections import OrderedDict
+from typing import Callable, Dict, List, Optional
+
+from .admission import AdmissionRejected
+
+# the user limiter a model is counted against, other models use gpt3Limiter
+MODEL_LIMITERS = {"gpt-4": "gpt4Limiter"}
+
+
+class RateLimited(AdmissionRejected):
+    def __init__(self, scope, message, retry_after, wait):
+        super().__init__(message, retry_after)
+        self.source = "ratelimit"
+        self.scope = scope
+        self.wait = wait
+
+
+class TokenBuckets:
+    """
+    Token buckets of many keys sharing one limit of ``capacity`` requests per ``duration`` seconds.
+
+    A bucket is kept as its tokens at the last update and refilled when it is
+    read, so a check is O(1). Only the ``max_keys`` most recently used buckets
+    are kept, an evicted key starts with a full bucket again.
+    """
+
+    def __init__(self, capacity, duration, max_keys=100000):
+        self.capacity = capacity
+        self.duration = duration
+        self.rate = capacity / duration
+        self.max_keys = max_keys
+        self.buckets: "OrderedDict[str, list]" = OrderedDict()
+
+    def _tokens(self, key, now) -> float:
+        bucket = self.buckets.get(key)
+        if bucket is None:
+            return self.capacity
+        tokens, updated = bucket
+        return min(self.capacity, tokens + (now - updated) * self.rate)
+
+    def wait(self, key, now=None, count=1) -> float:
+        """
+        Seconds until ``key`` has ``count`` tokens, 0 when it has them now.
+
+        More tokens than the bucket holds are granted from a full bucket, the
+        rest is paid back as debt.
+        """
+        now = time.monotonic() if now is None else now
+        count = min(count, self.capacity)
+        tokens = self._tokens(key, now)
+        return 0.0 if tokens >= count else (count - tokens) / self.rate
+
+    def take(self, key, now=None, count=1):
+        """Take tokens, requests that raced the last one leave the bucket in debt."""
+        now = time.monotonic() if now is None else now
+        tokens = self._tokens(key, now) - count
+        bucket = self.buckets.get(key)
+        if bucket is None:
+            self.buckets[key] = [tokens, now]
+            if len(self.buckets) > self.max_keys:
+                self.buckets.popitem(last=False)
+        else:
+            bucket[0] = tokens
+            bucket[1] = now
+            self.buckets.move_to_end(key)
+
+    def snapshot(self):
+        return {"capacity": self.capacity, "duration": self.duration, "keys": len(self.buckets)}
+
+
+class RateLimiter:
+    """
+    Request rate limits per user and model family, per account and for the whole engine.
+
+    Users are limited only by a ``gpt3Limiter``/``gpt4Limiter`` set for the
+    engine itself; the limiters of the bot exempt group chats and invited
+    users, which the engine can not tell apart. Account limits are taken when a request gets a
+    slot, the scheduler skips accounts without tokens. With several workers
+    every token taken is relayed to the others through ``on_take``.
+    """
+
+    def __init__(self, buckets: Dict[str, TokenBuckets] = None, enabled=True):
+        self.buckets = buckets or {}
+        self.enabled = enabled
+        self.on_take: Optional[Callable[[List[list]], None]] = None
+        self.rejected: Dict[str, int] = {}
+
+    @staticmethod
+    def from_config(config) -> "RateLimiter":
+        limiter_config = config["engine"].get("rateLimiter")
+        if limiter_config is None:
+            return RateLimiter(enabled=False)
+        max_keys = limiter_config.get("maxKeys", 100000)
+        buckets = {}
+        for name in ("gpt3Limiter", "gpt4Limiter", "batch", "credential", "global"):
+            limit = limiter_config.get(name)
+            if limit:
+                buckets[name] = TokenBuckets(limit["capacity"], limit["duration"], max_keys)
+        return RateLimiter(buckets)
+
+    def reject(self, scope, wait) -> RateLimited:
+        self.rejected[scope] = self.rejected.get(scope, 0) + 1
+        retry_after = max(1, math.ceil(wait))
+        logging.warning("[RateLimiter] {} limit reached, retry after {:.1f}s".format(scope, wait))
+        return RateLimited(
+            scope,
+            "😱 请求过于频繁，请{}秒后再试(Too many requests, please retry after {}s)".format(
+                retry_after, retry_after
+            ),
+            retry_after,
+            wait,
+        )
+
+    def acquire(self, user_key, model):
+        """Take a token of the user and of the engine, raise ``RateLimited`` when either has none."""
+        takes = [["global", "", 1]]
+        if user_key is not None:
+            takes.append([MODEL_LIMITERS.get(model, "gpt3Limiter"), user_key, 1])
+        self._acquire(takes)
+
+    def acquire_batch(self, user_key, models):
+        """
+        Charge every item of a batch to the user up front, ``models`` has one entry per item.
+
+        Items take tokens of the ``batch`` bucket when one is set, else of the
+        user limiters of their models like single requests do.
+        """
+        if "batch" in self.buckets:
+            self._acquire([["batch", user_key, len(models)]])
+            return
+        counts: Dict[str, int] = {}
+        for model in models:
+            name = MODEL_LIMITERS.get(model, "gpt3Limiter")
+            counts[name] = counts.get(name, 0) + 1
+        self._acquire([[name, user_key, count] for name, count in sorted(counts.items())])
+
+    def _acquire(self, takes):
+        if not self.enabled:
+            return
+        now = time.monotonic()
+        takes = [take for take in takes if take[0] in self.buckets]
+        scope, wait = None, 0.0
+        for name, key, count in takes:
+            bucket_wait = self.buckets[name].wait(key, now, count)
+            if bucket_wait > wait:
+                scope, wait = name, bucket_wait
+        if wait > 0:
+            raise self.reject(scope, wait)
+        for name, key, count in takes:
+            self.buckets[name].take(key, now, count)
+        self._publish(takes)
+
+    def credential_wait(self, email) -> float:
+        if not self.enabled or "credential" not in self.buckets:
+            return 0.0
+        return self.buckets["credential"].wait(email)
+
+    def take_credential(self, email):
+        if not self.enabled or "credential" not in self.buckets:
+            return
+        self.buckets["credential"].take(email)
+        self._publish([["credential", email, 1]])
+
+    def _publish(self, takes):
+        if self.on_take is not None and len(takes) != 0:
+            self.on_take(takes)
+
+    def apply(self, takes):
+        """Count the tokens another worker took."""
+        now = time.monotonic()
+        for name, key, count in takes:
+            if name in self.buckets:
+                self.buckets[name].take(key, now, count)
+
+    def snapshot(self):
+        return {
+            "enabled": self.enabled,
+            "limits": {name: buckets.snapshot() for name, buckets in self.buckets.items()},
+            "rejected": dict(self.rejected),
+        }
@@ -0,0 +1,171 @@
+import heapq
+import itertools
+import logging
+import time
+from collections import deque
+from typing import Dict, List
+
+from .credential import Credential
+
+
+class SchedulePolicy:
+    name = "base"
+
+    def score(self, credential: Credential) -> float:
+        raise NotImplementedError
+
+
+class LeastOutstandingPolicy(SchedulePolicy):
+    """Prefer the account with the lowest share of its slots in use."""
+
+    name = "least-outstanding"
+
+    def score(self, credential: Credential) -> float:
+        return credential.load() / credential.concurrency
+
+
+class EwmaLatencyPolicy(SchedulePolicy):
+    """Prefer the account with the lowest expected wait, i.e. latency times load."""
+
+    name = "ewma"
+
+    def __init__(self, default_latency=0.0):
+        self.default_latency = default_latency
+
+    def score(self, credential: Credential) -> float:
+        latency = credential.ewma_latency
+        if latency is None:
+            latency = self.default_latency
+        return latency * (credential.load() + 1) / credential.concurrency
+
+
+POLICIES = {
+    LeastOutstandingPolicy.name: LeastOutstandingPolicy,
+    EwmaLatencyPolicy.name: EwmaLatencyPolicy,
+}
+
+
+class CredentialScheduler:
+    """
+    Pick a credential from a heap ordered by the policy score.
+
+    Every credential change pushes a fresh heap entry and bumps its version,
+    older entries are dropped lazily when they reach the top, so a pick costs
+    O(log n) plus the accounts it has to skip.
+    """
+
+    def __init__(self, credentials: List[Credential], policy: SchedulePolicy = None, history=100):
+        self.policy = policy or LeastOutstandingPolicy()
+        self.credentials: List[Credential] = list(credentials)
+        self.heap = []
+        self.versions: Dict[int, int] = {}
+        self.counter = itertools.count()
+        self.decisions = deque(maxlen=history)
+        for credential in self.credentials:
+            self._watch(credential)
+
+    @staticmethod
+    def from_config(credentials: List[Credential], config) -> "CredentialScheduler":
+        name = config["engine"]["chatgpt"].get("scheduler", LeastOutstandingPolicy.name)
+        if name not in POLICIES:
+            raise Exception("unknown scheduler policy: {}".format(name))
+        return CredentialScheduler(credentials, POLICIES[name]())
+
+    def add(self, credential: Credential):
+        if credential not in self.credentials:
+            self.credentials.append(credential)
+        self._watch(credential)
+
+    def remove(self, credential: Credential):
+        """Stop picking ``credential``, its heap entries are dropped lazily as outdated."""
+        if credential in self.credentials:
+            self.credentials.remove(credential)
+        if self.update in credential.listeners:
+            credential.listeners.remove(self.update)
+        self.versions.pop(id(credential), None)
+
+    def _watch(self, credential: Credential):
+        credential.add_listener(self.update)
+        self.update(credential)
+
+    def update(self, credential: Credential):
+        key = id(credential)
+        version = self.versions.get(key, 0) + 1
+        self.versions[key] = version
+        # the counter breaks ties in push order, so equally loaded accounts rotate
+        heapq.heappush(
+            self.heap,
+            (self.policy.score(credential), next(self.counter), version, credential),
+        )
+        if len(self.heap) > 4 * len(self.credentials) + 16:
+            self._compact()
+
+    def _compact(self):
+        self.heap = [e for e in self.heap if self.versions.get(id(e[3])) == e[2]]
+        heapq.heapify(self.heap)
+
+    def pick(self, exclude=()) -> Credential:
+        """Pick the best usable credential, ``exclude`` is only used when nothing else is left."""
+        if len(self.credentials) == 0:
+            raise Exception("no chatgpt credential available")
+        skipped = []
+        chosen = None
+        while self.heap:
+            entry = heapq.heappop(self.heap)
+            score, _, version, credential = entry
+            if self.versions.get(id(credential)) != version:
+                continue
+            if credential.is_busy() or not credential.is_available() or credential in exclude:
+                skipped.append(entry)
+                continue
+            chosen = entry
+            break
+        for entry in skipped:
+            heapq.heappush(self.heap, entry)
+        if chosen is None:
+            # every account is busy or unhealthy, queue on the least bad one; the
+            # session turns a request away instead when its breaker is still open
+            chosen = min(skipped, key=lambda e: (e[3] in exclude, self._fallback_key(e)))
+        score, _, _, credential = chosen
+        # re-queue behind accounts with the same score
+        self.update(credential)
+        self._record(credential, score, skipped)
+        return credential
+
+    @staticmethod
+    def _fallback_key(entry):
+        credential = entry[3]
+        return (
+            credential.breaker.opened_until if credential.breaker.opened else 0.0,
+            credential.quota_wait(),
+            entry[0],
+        )
+
+    def _record(self, credential: Credential, score, skipped):
+        decision = {
+            "time": time.time(),
+            "policy": self.policy.name,
+            "chosen": credential.email,
+            "score": score,
+            "skipped": [entry[3].email for entry in skipped],
+        }
+        self.decisions.append(decision)
+        logging.debug("[Scheduler] pick {}".format(decision))
+
+    def snapshot(self):
+        return {
+            "policy": self.policy.name,
+            "credentials": [
+                {
+                    "email": c.email,
+                    "in_flight": c.in_flight,
+                    "concurrency": c.concurrency,
+                    "ewma_latency": c.ewma_latency,
+                    "breaker": c.breaker.snapshot(),
+                    "score": self.policy.score(c),
+                    "init_time": c.init_time,
+                }
+                for c in self.credentials
+            ],
+            "decisions": list(self.decisions),
+        }
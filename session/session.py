@@ -1,5 +1,7 @@
 import asyncio
 import logging
+import math
+import os
 import random
 import time
 from typing import List, Dict, AsyncGenerator
@@ -10,240 +12,983 @@ from ChatGPT2API.typings import Error as ChatGPTError
 
 from ChatGPT2API.typings import ErrorType as ChatGPTErrorType
 
+from tool import load_yaml
+
+from .admission import AdmissionController, AdmissionRejected
+from .affinity import AffinityIndex
+from .coordinator import CoordinatorClient
 from .credential import Credential
+from .delta import StreamDelta
+from .hedge import HedgePolicy
+from .metrics import MetricsRegistry, upstream_response
+from .persistence import SessionPersistence
+from .prompt_cache import PromptCache
+from .ratelimit import RateLimiter
+from .scheduler import CredentialScheduler
+from .store import SessionStore
+from .transport import SharedTransport
 from .user_session import UserSession
 
+FAILOVER_ERRORS = (
+    ChatGPTErrorType.RATE_LIMIT_ERROR,
+    ChatGPTErrorType.SERVER_ERROR,
+    ChatGPTErrorType.EXPIRED_ACCESS_TOKEN_ERROR,
+    ChatGPTErrorType.INVALID_ACCESS_TOKEN_ERROR,
+)
+SESSION_MODELS = ("text-davinci-002-render-sha", "text-davinci-002-render-paid", "gpt-4")
+
 
 class Session:
-    def __init__(self, config):
-        self.used_chatgpt_credentials_indexes = []
-        try:
-            self.chatgpt_credentials: List[Credential] = list(
-                map(Credential.parse, config["engine"]["chatgpt"]["tokens"])
-            )
-        except OpenAIAuth.Error as e:
-            logging.error(
-                "Init Credential Error: status: {}, details: {}".format(
-                    e.status_code, e.details
-                )
-            )
-            raise e
+    def __init__(self, config, coordinator: CoordinatorClient = None, config_path=None):
+        self.config = config
+        self.pending_credentials: List[Credential] = list(
+            map(Credential.parse, config["engine"]["chatgpt"]["tokens"])
+        )
+        self.chatgpt_credentials: List[Credential] = []
+        self.credentials_by_email: Dict[str, Credential] = {}
         self.chat_gpt_bot = None
         self.edge_gpt_bot = None
-        self.user_to_session: Dict[str, UserSession] = dict()
-        self.user_to_paid_session: Dict[str, UserSession] = dict()
-        self.user_to_gpt4_session: Dict[str, UserSession] = dict()
+        self.user_sessions = SessionStore.from_config(config)
+        self.persistence = SessionPersistence.from_config(config)
 
         self.verbose = config["engine"].get("debug", False)
+        self.concurrency = config["engine"]["chatgpt"].get("concurrency", 1)
+        self.transport = SharedTransport.from_config(config)
+        self.rate_limiter = RateLimiter.from_config(config)
+        self.breaker_config = config["engine"]["chatgpt"].get("breaker", {}) or {}
+        self.refresh_ahead = config["engine"]["chatgpt"].get("refreshAhead", 600)
+        self.init_concurrency = config["engine"]["chatgpt"].get("initConcurrency", 8)
+        self.min_ready = config["engine"]["chatgpt"].get("minReady", 1)
+        self.initializer = None
+        self.scheduler = CredentialScheduler.from_config(
+            self.chatgpt_credentials, config
+        )
+        self.admission = AdmissionController.from_config(self.capacity, config)
+        failover_config = config["engine"]["chatgpt"].get("failover", {}) or {}
+        self.failover_retries = failover_config.get("retries", 2)
+        self.failover_budget = failover_config.get("budget", 20)
+        self.failover_jitter = failover_config.get("jitter", 0.2)
+        self.failover_stats = {"attempts": 0, "recovered": 0, "exhausted": 0}
+        self.breaker_rejected = 0
+        self.hedging = HedgePolicy.from_config(config)
+        affinity_config = config["engine"]["chatgpt"].get("affinity", {}) or {}
+        self.affinity = AffinityIndex(max_size=affinity_config.get("maxSize", 50000))
+        self.affinity_max_waiting = affinity_config.get("maxWaiting", 4)
+        self.metrics = MetricsRegistry()
+        self.stage_seconds = self.metrics.histogram(
+            "engine_stage_seconds",
+            "Seconds spent in each stage of a chat request",
+            ("stage", "model", "credential"),
+        )
+        self.metrics.gauge(
+            "engine_sessions", "User sessions in memory", (),
+            lambda: {(): len(self.user_sessions)},
+        )
+        self.metrics.gauge(
+            "engine_admission_queue_depth", "Requests waiting for admission", ("model",),
+            lambda: {(model,): len(queue) for model, queue in self.admission.queues.items()},
+        )
+        self.metrics.gauge(
+            "engine_credential_in_flight", "Requests holding a slot of an account", ("credential",),
+            lambda: {(c.label,): c.in_flight for c in self.chatgpt_credentials},
+        )
+        self.metrics.gauge(
+            "engine_upstream_requests", "Requests sent upstream over the shared pool", (),
+            lambda: {(): self.transport.requests},
+        )
+        self.metrics.gauge(
+            "engine_upstream_connections", "Upstream connections opened by the shared pool", (),
+            lambda: {(): self.transport.connections},
+        )
+        self.metrics.gauge(
+            "engine_upstream_handshake_seconds_saved",
+            "Connect and tls seconds saved by reusing pooled connections", (),
+            lambda: {(): self.transport.snapshot()["handshake_seconds_saved"]},
+        )
+        self.metrics_pusher = None
+        self.prompt_cache = PromptCache.from_config(
+            self.metrics.counter(
+                "engine_prompt_cache_total",
+                "Stateless prompts answered from cache, joined in flight or sent upstream",
+                ("result",),
+            ),
+            config,
+        )
+        # set when this is one of several worker processes
+        self.coordinator = coordinator
+        self.workers = config["engine"].get("workers", 1) if coordinator is not None else 1
+        if coordinator is not None:
+            coordinator.on_breaker = self._apply_breaker
+            coordinator.on_held = self._apply_held
+            coordinator.on_token = self._apply_token
+            coordinator.on_rate_limit = self.rate_limiter.apply
+            self.rate_limiter.on_take = coordinator.publish_rate_limit
+            coordinator.on_reload = self._reload_relayed
+        for c in self.pending_credentials:
+            self._configure_credential(c)
+        reload_config = config["engine"].get("reload", {}) or {}
+        self.config_path = config_path
+        self.watch_interval = reload_config.get("watchInterval", 5)
+        self.retire_timeout = reload_config.get("drainTimeout", 300)
+        self.watcher = None
+        self.reload_lock = None
+        self.background = set()
+        self.reload_stats = {"reloads": 0, "failed": 0, "added": 0, "removed": 0, "last": None}
+
+    def _configure_credential(self, credential: Credential):
+        credential.set_verbose(self.verbose)
+        credential.set_concurrency(self.concurrency)
+        credential.set_transport(self.transport)
+        credential.set_rate_limiter(self.rate_limiter)
+        credential.set_breaker(
+            failure_threshold=self.breaker_config.get("failureThreshold", 3),
+            cooldown=self.breaker_config.get("cooldown", 60),
+            max_cooldown=self.breaker_config.get("maxCooldown", 900),
+        )
+        if self.coordinator is not None:
+            # a request never waits for a slot longer than it may wait for admission
+            credential.set_coordinator(self.coordinator, self.admission.max_wait)
+
+    async def start(self):
+        """Initialize credentials concurrently, return once ``min_ready`` of them are usable."""
+        if self.coordinator is not None:
+            await self.coordinator.connect()
+        self.user_sessions.start()
+        await self.persistence.start()
+        await self._restore_sessions()
+        if self.coordinator is not None:
+            self.metrics_pusher = asyncio.create_task(self._push_metrics_forever())
+        ready = asyncio.Event()
+        self.initializer = asyncio.create_task(self._init_credentials(ready))
+        await ready.wait()
+        if len(self.chatgpt_credentials) == 0:
+            raise Exception("no chatgpt credential could be initialized")
+        self.reload_lock = asyncio.Lock()
+        if self.config_path is not None and self.watch_interval > 0:
+            self.watcher = asyncio.create_task(self._watch_config())
+
+    async def stop(self):
+        self.user_sessions.stop()
+        await self.persistence.stop()
+        if self.initializer is not None:
+            self.initializer.cancel()
+        if self.watcher is not None:
+            self.watcher.cancel()
+        for task in list(self.background):
+            task.cancel()
         for c in self.chatgpt_credentials:
-            c.set_verbose(self.verbose)
-
-    def _get_random_chat_gpt_credential(self):
-        length_range = len(self.chatgpt_credentials) - 1
-        index = random.randint(0, length_range)
-        while index in self.used_chatgpt_credentials_indexes:
-            if len(self.used_chatgpt_credentials_indexes) == len(
-                self.chatgpt_credentials
+            c.stop_renewer()
+        if self.metrics_pusher is not None:
+            self.metrics_pusher.cancel()
+        if self.coordinator is not None:
+            await self.coordinator.close()
+        await self.transport.aclose()
+
+    async def _push_metrics_forever(self, interval=5):
+        # /metrics on any worker adds up the snapshots of all of them
+        while True:
+            await asyncio.sleep(interval)
+            self.coordinator.push_metrics(self.metrics.snapshot())
+
+    def observe_stage(self, stage, model, label, start_time):
+        self.stage_seconds.observe((stage, model, label), time.monotonic() - start_time)
+
+    def _apply_breaker(self, email, state):
+        for c in self.chatgpt_credentials + self.pending_credentials:
+            if c.email == email:
+                c.breaker.apply(state)
+
+    def _apply_held(self, email, held):
+        for c in self.chatgpt_credentials + self.pending_credentials:
+            if c.email == email:
+                c.set_pool_in_flight(held)
+
+    def _apply_token(self, email, access_token, refresh_token):
+        for c in self.chatgpt_credentials + self.pending_credentials:
+            if c.email == email and not c.retired:
+                c.apply_refreshed_token(access_token, refresh_token)
+
+    async def _init_credentials(self, ready: asyncio.Event):
+        start_time = time.monotonic()
+        total = len(self.pending_credentials)
+        min_ready = min(self.min_ready, total)
+        semaphore = asyncio.Semaphore(self.init_concurrency)
+
+        async def init_credential(credential: Credential):
+            if await self._init_credential(credential, semaphore) and (
+                len(self.chatgpt_credentials) >= min_ready
             ):
-                self.used_chatgpt_credentials_indexes = []
-            index = random.randint(0, length_range)
+                ready.set()
 
-        self.used_chatgpt_credentials_indexes.append(index)
-        return self.chatgpt_credentials[index]
+        try:
+            await asyncio.gather(
+                *[init_credential(c) for c in list(self.pending_credentials)]
+            )
+        finally:
+            ready.set()
+        logging.info(
+            "[Session] credentials ready: {}/{} in {:.2f}s, timings: {}".format(
+                len(self.chatgpt_credentials),
+                total,
+                time.monotonic() - start_time,
+                ", ".join(
+                    "{}={:.2f}s".format(c.email, c.init_time)
+                    for c in self.chatgpt_credentials
+                ),
+            )
+        )
 
-    def _clean_session(self, user_id):
-        if user_id is None:
-            return
+    async def _init_credential(self, credential: Credential, semaphore: asyncio.Semaphore):
+        """Log in a pending account and add it to the pool, return whether it joined."""
+        async with semaphore:
+            try:
+                await credential.init()
+            except OpenAIAuth.Error as e:
+                logging.error(
+                    "Init Credential Error: status: {}, details: {}".format(
+                        e.status_code, e.details
+                    )
+                )
+                return False
+            except Exception as e:
+                logging.error("Init Credential Error: {}".format(e))
+                return False
+        if credential.retired:
+            # removed by a reload while it was logging in
+            return False
+        self.pending_credentials.remove(credential)
+        self._add_credential(credential)
+        return True
+
+    def _spawn(self, coroutine):
+        task = asyncio.create_task(coroutine)
+        self.background.add(task)
+        task.add_done_callback(self.background.discard)
+        return task
+
+    async def _watch_config(self):
+        """Reload the config file when its modification time changes, stat and parsing run in the executor."""
+        loop = asyncio.get_running_loop()
+        mtime = await loop.run_in_executor(None, os.path.getmtime, self.config_path)
+        while True:
+            await asyncio.sleep(self.watch_interval)
+            try:
+                current = await loop.run_in_executor(None, os.path.getmtime, self.config_path)
+            except OSError as e:
+                logging.warning("[Reload] can not stat {}: {}".format(self.config_path, e))
+                continue
+            if current != mtime:
+                mtime = current
+                logging.info("[Reload] {} changed".format(self.config_path))
+                await self._try_reload()
+
+    async def _try_reload(self):
         try:
-            del self.user_to_gpt4_session[user_id]
+            await self.reload_from_file()
         except Exception as _:
+            # logged already, the running config stays until the next reload
             pass
 
+    def _reload_relayed(self):
+        # another worker was asked to reload, every worker reads the same file
+        self._spawn(self._try_reload())
+
+    async def reload_from_file(self, publish=False):
+        if self.config_path is None:
+            raise Exception("the engine was not started from a config file")
+        loop = asyncio.get_running_loop()
         try:
-            del self.user_to_session[user_id]
-        except Exception as _:
-            pass
+            config = await loop.run_in_executor(None, load_yaml, self.config_path)
+            result = await self.reload(config)
+        except Exception as e:
+            self.reload_stats["failed"] += 1
+            logging.error("[Reload] failed, keeping the running config: {}".format(e))
+            raise
+        if publish and self.coordinator is not None:
+            self.coordinator.publish_reload()
+        return result
 
-    def _get_user_session(self, user_id) -> UserSession:
-        if user_id in self.user_to_session:
-            return self.user_to_session[user_id]
-        else:
-            credential = self._get_random_chat_gpt_credential()
-            session = UserSession(user_id=user_id, credential=credential)
-            self.user_to_session[user_id] = session
-            return session
-
-    def _get_user_paid_session(self, user_id) -> UserSession:
-        if user_id in self.user_to_paid_session:
-            return self.user_to_paid_session[user_id]
-        else:
-            credential = self._get_random_chat_gpt_credential()
-            session = UserSession(user_id=user_id, credential=credential)
-            self.user_to_paid_session[user_id] = session
-            return session
+    async def reload(self, config):
+        """
+        Apply the accounts of ``config`` to the running pool.
+
+        New accounts log in in the background and join once ready, removed
+        ones stop taking requests at once and leave after the requests they
+        hold finished. An account whose token line changed is replaced.
+        Other settings still need a restart, they are only reported.
+        """
+        async with self.reload_lock:
+            old_tokens = {Credential.parse(t).email: t for t in self.config["engine"]["chatgpt"]["tokens"]}
+            new_tokens = {Credential.parse(t).email: t for t in config["engine"]["chatgpt"]["tokens"]}
+            removed = [email for email, token in old_tokens.items() if new_tokens.get(email) != token]
+            added = [email for email, token in new_tokens.items() if old_tokens.get(email) != token]
+            restart_required = self._restart_required(config)
+
+            for email in removed:
+                for credential in self.chatgpt_credentials + self.pending_credentials:
+                    if credential.email == email and not credential.retired:
+                        self._retire(credential)
+            credentials = [Credential.parse(new_tokens[email]) for email in added]
+            for credential in credentials:
+                self._configure_credential(credential)
+                self.pending_credentials.append(credential)
+            if len(credentials) != 0:
+                self._spawn(self._warm_up(credentials))
+
+            self.config = config
+            self.reload_stats["reloads"] += 1
+            self.reload_stats["added"] += len(added)
+            self.reload_stats["removed"] += len(removed)
+            self.reload_stats["last"] = time.time()
+            if restart_required:
+                logging.warning("[Reload] changed settings need a restart: {}".format(", ".join(restart_required)))
+            logging.info("[Reload] accounts added: {}, removed: {}".format(added, removed))
+            return {"added": added, "removed": removed, "restart_required": restart_required}
+
+    def _restart_required(self, config):
+        old, new = self.config["engine"], config["engine"]
+        changed = [
+            key for key in sorted(set(old) | set(new))
+            if key != "chatgpt" and old.get(key) != new.get(key)
+        ]
+        old_chatgpt, new_chatgpt = old.get("chatgpt", {}), new.get("chatgpt", {})
+        changed += [
+            "chatgpt." + key for key in sorted(set(old_chatgpt) | set(new_chatgpt))
+            if key != "tokens" and old_chatgpt.get(key) != new_chatgpt.get(key)
+        ]
+        return changed
+
+    async def _warm_up(self, credentials: List[Credential]):
+        semaphore = asyncio.Semaphore(self.init_concurrency)
+        joined = await asyncio.gather(*[self._init_credential(c, semaphore) for c in credentials])
+        logging.info(
+            "[Reload] accounts warmed up: {}/{}".format(sum(joined), len(credentials))
+        )
+
+    def _retire(self, credential: Credential):
+        """Take an account out of the pool, requests it holds may finish first."""
+        credential.retired = True
+        if credential in self.pending_credentials:
+            self.pending_credentials.remove(credential)
+            return
+        self.scheduler.remove(credential)
+        credential.stop_renewer()
+        if self.coordinator is not None:
+            self.coordinator.drop_token(credential.email)
+        self._spawn(self._drain_credential(credential))
+
+    async def _drain_credential(self, credential: Credential, interval=0.5):
+        deadline = time.monotonic() + self.retire_timeout
+        while (credential.in_flight > 0 or credential.waiting > 0) and time.monotonic() < deadline:
+            await asyncio.sleep(interval)
+        if credential.in_flight > 0:
+            logging.warning(
+                "[Reload] {} left with {} requests in flight".format(credential.email, credential.in_flight)
+            )
+        self.chatgpt_credentials.remove(credential)
+        if self.credentials_by_email.get(credential.email) is credential:
+            del self.credentials_by_email[credential.email]
+        logging.info("[Reload] account removed: {}".format(credential.email))
+
+    def reload_snapshot(self):
+        return {
+            **self.reload_stats,
+            "config_path": self.config_path,
+            "watch_interval": self.watch_interval if self.config_path is not None else 0,
+            "retiring": [c.email for c in self.chatgpt_credentials if c.retired],
+            "pending": [c.email for c in self.pending_credentials],
+        }
+
+    def _session_from_row(self, row) -> UserSession:
+        _, user_id, conversation_id, parent_id, email, last_time = row
+        session = UserSession(
+            user_id=user_id,
+            conversation_id=conversation_id,
+            parent_id=parent_id,
+            credential=self.credentials_by_email.get(email),
+        )
+        session.last_time = last_time
+        if email is not None:
+            # the account may still be initializing, the index only keeps its email
+            self.affinity.bind(conversation_id, email)
+        return session
+
+    async def _restore_sessions(self):
+        start_time = time.monotonic()
+        rows = await self.persistence.load_recent(self.user_sessions.max_size)
+        # most recent first, insert oldest first to keep the LRU order
+        for row in reversed(rows):
+            self.user_sessions.put(row[0], row[1], self._session_from_row(row))
+        if len(rows) > 0:
+            logging.info(
+                "[Session] restored {} user sessions in {:.2f}s".format(
+                    len(rows), time.monotonic() - start_time
+                )
+            )
+
+    async def _load_session(self, user_id, model):
+        """
+        Bring the session of a user up to date before it is used.
+
+        With several workers the coordinator holds the latest state, the
+        previous message may have been served by another worker. Otherwise a
+        session evicted from memory, or saved by a previous run, is read back
+        from the database.
+        """
+        if user_id is None or (not self.persistence.enabled and self.coordinator is None):
+            return
+        model = self._session_model(model)
+        local = self.user_sessions.get(model, user_id)
+        if self.coordinator is not None:
+            try:
+                row = await self.coordinator.get_session(model, user_id)
+            except ConnectionError as e:
+                # fall back to what this worker knows until the coordinator is back
+                logging.warning("[Session] coordinator session lookup failed: {}".format(e))
+                row = None
+            if row is not None and (local is None or row[5] > local.last_time):
+                self.user_sessions.put(model, user_id, self._session_from_row(row))
+                return
+        if local is not None:
+            return
+        row = await self.persistence.load(model, user_id)
+        if row is not None and self.user_sessions.get(model, user_id) is None:
+            self.user_sessions.put(model, user_id, self._session_from_row(row))
+
+    def _save_session(self, model, user_id, session: UserSession):
+        if user_id is None:
+            return
+        model = self._session_model(model)
+        self.persistence.save(model, user_id, session)
+        if self.coordinator is not None:
+            self.coordinator.put_session(session.row(model))
+
+    def _add_credential(self, credential: Credential):
+        self.chatgpt_credentials.append(credential)
+        self.credentials_by_email[credential.email] = credential
+        self.scheduler.add(credential)
+        credential.start_renewer(self.refresh_ahead)
+
+    def capacity(self):
+        """The share of the pool slots this worker admits, every worker admits the same share."""
+        total = sum(c.concurrency for c in self.chatgpt_credentials if not c.retired)
+        return -(-total // self.workers)
+
+    def _get_chat_gpt_credential(self, exclude=()):
+        return self.scheduler.pick(exclude)
+
+    def _clean_session(self, user_id):
+        if user_id is None:
+            return
+        for model in SESSION_MODELS:
+            self.user_sessions.remove(model, user_id)
+            self.persistence.delete(model, user_id)
+        if self.coordinator is not None:
+            self.coordinator.remove_sessions(user_id)
+
+    @staticmethod
+    def _session_model(model):
+        if model not in SESSION_MODELS:
+            return "text-davinci-002-render-sha"
+        return model
 
     def _get_session_from_model_and_id(
         self, user_id, model="text-davinci-002-render-sha"
-    ):
-        if model == "gpt-4":
-            return self._get_user_gpt4_session(user_id)
-        elif model == "text-davinci-002-render-paid":
-            return self._get_user_paid_session(user_id)
-        else:
-            return self._get_user_session(user_id)
+    ) -> UserSession:
+        # the account is picked by _get_credential_from_session once a request needs it
+        model = self._session_model(model)
+        if user_id is None:
+            # without a user there is no conversation to continue
+            return UserSession(user_id=None, credential=None)
+        session = self.user_sessions.get(model, user_id)
+        if session is None:
+            session = UserSession(user_id=user_id, credential=None)
+            self.user_sessions.put(model, user_id, session)
+        return session
+
+    def _get_credential_from_session(self, session: UserSession, exclude=()):
+        if session.conversation_id is None:
+            credential = session.credential
+            if (
+                credential is None
+                or credential in exclude
+                or credential.is_busy()
+                or not credential.is_available()
+            ):
+                session.credential = self._get_chat_gpt_credential(exclude)
+            return session.credential
 
-    def _get_user_gpt4_session(self, user_id) -> UserSession:
-        if user_id in self.user_to_gpt4_session:
-            return self.user_to_gpt4_session[user_id]
+        # a conversation only exists on the account that started it
+        credential = self.credentials_by_email.get(
+            self.affinity.owner(session.conversation_id)
+        )
+        if credential is None and session.credential is not None:
+            # forgotten by the bounded index, the session still knows its account
+            credential = session.credential
+            self.affinity.bind(session.conversation_id, credential.email)
+        if credential is None:
+            reason = "unknown"
+        elif credential in exclude or not credential.is_available():
+            reason = "unavailable"
+        elif credential.waiting >= self.affinity_max_waiting:
+            reason = "overloaded"
         else:
-            credential = self._get_random_chat_gpt_credential()
-            session = UserSession(user_id=user_id, credential=credential)
-            self.user_to_gpt4_session[user_id] = session
-            return session
-
-    def _get_credential_from_session(self, session: UserSession):
-        if time.time() - session.last_time > 60 * 5:
-            credential = self._get_random_chat_gpt_credential()
+            self.affinity.hit()
             session.credential = credential
+            return credential
+        # rebalance by starting a new conversation on another account
+        self.affinity.miss(reason)
+        session.credential = self._get_chat_gpt_credential(exclude)
+        session.conversation_id = None
+        session.parent_id = None
         return session.credential
 
+    def check_rate_limit(self, user_id, model, client=None):
+        """Count a request against the user and engine limits, requests without a user count per client."""
+        key = user_id
+        if key is None and client is not None:
+            key = "client:{}".format(client)
+        self.rate_limiter.acquire(key, model)
+
+    def check_batch_rate_limit(self, models, client):
+        """Count every item of a batch against the limits of its client, ``models`` has one entry per item."""
+        self.rate_limiter.acquire_batch("client:{}".format(client), models)
+
+    def _check_credential_quota(self, credential: Credential):
+        if credential.quota_wait() == 0:
+            return
+        # the scheduler prefers accounts with tokens left, so no usable one has any
+        waits = [c.quota_wait() for c in self.chatgpt_credentials if c.breaker.available()]
+        raise self.rate_limiter.reject("credential", min(waits or [credential.quota_wait()]))
+
+    def _check_credential_health(self, credential: Credential):
+        if credential.breaker.available():
+            return
+        # the scheduler prefers healthy accounts, so every account is cooling down
+        wait = min(c.breaker.retry_in() for c in self.chatgpt_credentials if not c.retired)
+        retry_after = max(1, math.ceil(wait))
+        self.breaker_rejected += 1
+        logging.warning("[Breaker] every account is open, retry after {:.1f}s".format(wait))
+        raise AdmissionRejected(
+            "😱 账号暂不可用，请{}秒后再试(Every account is cooling down, please retry after {}s)".format(
+                retry_after, retry_after
+            ),
+            retry_after,
+        )
+
+    def readiness(self):
+        # an account out of rate limit tokens is healthy, its requests get a retry-after
+        usable = sum(1 for c in self.chatgpt_credentials if c.breaker.available() and not c.retired)
+        required = min(self.min_ready, len(self.chatgpt_credentials) + len(self.pending_credentials))
+        return {
+            "ready": usable > 0 and usable >= required,
+            "usable": usable,
+            "required": required,
+            "total": len(self.chatgpt_credentials),
+        }
+
+    def breaker_snapshot(self):
+        states = {}
+        for c in self.chatgpt_credentials:
+            state = c.breaker.state
+            states[state] = states.get(state, 0) + 1
+        return {
+            "usable": sum(1 for c in self.chatgpt_credentials if c.is_available()),
+            "total": len(self.chatgpt_credentials),
+            "states": states,
+            "rejected": self.breaker_rejected,
+            "credentials": {c.email: c.breaker.snapshot() for c in self.chatgpt_credentials},
+        }
+
     async def chat_with_chatgpt(
-        self, sentence: str, user_id=None, model="text-davinci-002-render-sha"
+        self, sentence: str, user_id=None, model="text-davinci-002-render-sha", stateless=False
     ) -> str:
-        session = self._get_session_from_model_and_id(user_id, model)
-        credential = self._get_credential_from_session(session)
-        credential.chat_gpt_bot.conversation_id = None
+        if self.prompt_cache.enabled and (stateless or user_id is None):
+            return await self.prompt_cache.ask(
+                model, sentence, lambda: self._chat_stream(sentence, None, model)
+            )
+        admission_start = time.monotonic()
+        async with self.admission.admit(model):
+            self.observe_stage("admission", model, "", admission_start)
+            await self._load_session(user_id, model)
+            start_time = time.monotonic()
+            new_conversation = self._is_new_conversation(user_id, model)
+            tried = []
+            while True:
+                try:
+                    res = await self._chat_with_chatgpt(sentence, user_id, model, tried)
+                except ChatGPTError as e:
+                    if await self._failover(e, new_conversation, tried, start_time):
+                        continue
+                    raise e
+                self._failover_done(tried)
+                return res
+
+    async def chat_stream_with_chatgpt(
+        self, sentence: str, user_id=None, model="text-davinci-002-render-sha", stateless=False
+    ) -> AsyncGenerator[str, None]:
+        if self.prompt_cache.enabled and (stateless or user_id is None):
+            stream = self.prompt_cache.stream(
+                model, sentence, lambda: self._chat_stream(sentence, None, model)
+            )
+        else:
+            stream = self._chat_stream(sentence, user_id, model)
+        try:
+            async for message in stream:
+                yield message
+        finally:
+            await stream.aclose()
+
+    async def _chat_stream(self, sentence, user_id, model) -> AsyncGenerator[str, None]:
+        admission_start = time.monotonic()
+        async with self.admission.admit(model):
+            self.observe_stage("admission", model, "", admission_start)
+            await self._load_session(user_id, model)
+            start_time = time.monotonic()
+            new_conversation = self._is_new_conversation(user_id, model)
+            tried = []
+            while True:
+                try:
+                    stream, first = await self._open_stream(
+                        sentence, user_id, model, tried, hedge=new_conversation
+                    )
+                except ChatGPTError as e:
+                    if await self._failover(e, new_conversation, tried, start_time):
+                        continue
+                    raise e
+                # once a token reached the client the answer can not be replayed
+                try:
+                    if first is not None:
+                        yield first
+                    async for message in stream:
+                        yield message
+                finally:
+                    await stream.aclose()
+                self._failover_done(tried)
+                return
+
+    async def _open_stream(self, sentence, user_id, model, tried, hedge=False):
+        """
+        Start a stream and wait for its first message.
+
+        With hedging on, a slow first token starts a second attempt on an idle
+        account, the first to answer is kept and the other one is cancelled.
+        Returns the stream and its first message, None when it was empty.
+        """
+        start_time = time.monotonic()
+        attempts = {}
+
+        def start_attempt():
+            stream = self._chat_stream_with_chatgpt(sentence, user_id, model, tried)
+            task = asyncio.ensure_future(stream.__anext__())
+            # the attempt appends its credential to tried as soon as it runs
+            attempts[task] = (stream, time.monotonic(), len(tried))
+            return task
+
+        primary = start_attempt()
+        pending = {primary}
+        hedged = False
+        error = None
+        try:
+            if hedge and self.hedging.enabled:
+                done, pending = await asyncio.wait(pending, timeout=self.hedging.delay())
+                if len(done) == 0 and self._has_spare_capacity(tried):
+                    hedged = True
+                    logging.info(
+                        "[Session] hedge slow first token of user {} after {:.2f}s".format(
+                            user_id, time.monotonic() - start_time
+                        )
+                    )
+                    pending.add(start_attempt())
+                pending |= done
+            while pending:
+                done, pending = await asyncio.wait(
+                    pending, return_when=asyncio.FIRST_COMPLETED
+                )
+                # attempts that answered in the same round prefer the primary
+                for task in sorted(done, key=lambda t: t is not primary):
+                    stream, _, index = attempts[task]
+                    try:
+                        first = task.result()
+                    except StopAsyncIteration:
+                        first = None
+                    except Exception as e:
+                        error = e
+                        continue
+                    ttft = time.monotonic() - start_time
+                    # the primary attempt alone samples time to first token as if
+                    # nothing was hedged, when it lost its wait is a lower bound
+                    if primary is task or not primary.done():
+                        self.hedging.record_attempt(time.monotonic() - attempts[primary][1])
+                    hedge_won = hedged and task is not primary and not primary.done()
+                    # answered or not, every other attempt gives back its slot now
+                    losers = [t for t in attempts if t is not task]
+                    pending = set()
+                    await self._close_attempts(losers, attempts)
+                    if hedged and user_id is not None:
+                        # both attempts share the user session, keep it on the winner
+                        self._get_session_from_model_and_id(user_id, model).credential = tried[index]
+                    self.hedging.record_request(
+                        ttft=ttft,
+                        unhedged_ttft=self.hedging.estimate_beyond(ttft) if hedge_won else ttft,
+                        hedged=hedged,
+                        hedge_won=hedge_won,
+                    )
+                    return stream, first
+        except asyncio.CancelledError:
+            # the client left, no attempt may keep its account slot or upstream request
+            await self._close_attempts(list(attempts), attempts)
+            raise
+        raise error
+
+    @staticmethod
+    async def _close_attempts(tasks, attempts):
+        for task in tasks:
+            task.cancel()
+        if tasks:
+            await asyncio.wait(tasks)
+        for task in tasks:
+            await attempts[task][0].aclose()
+
+    @staticmethod
+    def _classify_error(e: ChatGPTError):
+        """Turn the http status of an upstream error into its error type, failover decides on the type."""
+        code = e.code
+        if code in (401, 403) or code in (
+            ChatGPTErrorType.EXPIRED_ACCESS_TOKEN_ERROR,
+            ChatGPTErrorType.INVALID_ACCESS_TOKEN_ERROR,
+        ):
+            if not isinstance(code, ChatGPTErrorType):
+                e.code = ChatGPTErrorType.INVALID_ACCESS_TOKEN_ERROR
+            e.message = "OpenAI Token Invalid, please retry"
+        elif code == ChatGPTErrorType.SERVER_ERROR or (
+            isinstance(code, int) and code >= 500
+        ):
+            e.code = ChatGPTErrorType.SERVER_ERROR
+            e.message = "OpenAI Server Error"
+        elif code == 429 or code == ChatGPTErrorType.RATE_LIMIT_ERROR:
+            e.code = ChatGPTErrorType.RATE_LIMIT_ERROR
+            e.message = "Too many requests, please retry later"
+        elif not isinstance(code, ChatGPTErrorType):
+            e.code = ChatGPTErrorType.UNKNOWN_ERROR
+            e.message = "Unknown Error"
+
+    def _has_spare_capacity(self, tried):
+        if self.admission.enabled and self.admission.waiting() != 0:
+            return False
+        return any(
+            c not in tried and c.is_available() and not c.is_busy()
+            for c in self.chatgpt_credentials
+        )
+
+    def _is_new_conversation(self, user_id, model):
+        if user_id is None:
+            return True
+        session = self.user_sessions.get(self._session_model(model), user_id)
+        return session is None or session.conversation_id is None
+
+    async def _failover(self, e: ChatGPTError, new_conversation, tried, start_time):
+        """Wait a jittered moment and return True when the request should move to another account."""
+        if not new_conversation or e.code not in FAILOVER_ERRORS:
+            return False
+        if len(tried) > self.failover_retries:
+            self.failover_stats["exhausted"] += 1
+            return False
+        delay = random.uniform(0, self.failover_jitter)
+        if time.monotonic() - start_time + delay > self.failover_budget:
+            self.failover_stats["exhausted"] += 1
+            return False
+        if not any(c.is_available() and c not in tried for c in self.chatgpt_credentials):
+            self.failover_stats["exhausted"] += 1
+            return False
+        self.failover_stats["attempts"] += 1
+        logging.warning(
+            "[Session] failover after {} on {}, attempt {}".format(
+                e.code, tried[-1].email, len(tried)
+            )
+        )
+        await asyncio.sleep(delay)
+        return True
 
-        if credential.lock is None:
-            credential.lock = asyncio.Lock()
+    def _failover_done(self, tried):
+        if len(tried) > 1:
+            self.failover_stats["recovered"] += 1
 
-        async with credential.lock:
+    async def _chat_with_chatgpt(
+        self, sentence: str, user_id=None, model="text-davinci-002-render-sha", tried=None
+    ) -> str:
+        tried = [] if tried is None else tried
+        session = self._get_session_from_model_and_id(user_id, model)
+        credential = self._get_credential_from_session(session, tried)
+        self._check_credential_health(credential)
+        self._check_credential_quota(credential)
+        tried.append(credential)
+
+        slot_start = time.monotonic()
+        async with credential.acquire() as chat_gpt_bot:
+            self.observe_stage("slot", model, credential.label, slot_start)
             try:
-                if model is not None:
-                    credential.chat_gpt_bot.config["model"] = model
-                else:
-                    credential.chat_gpt_bot.config["model"] = None
-                res = ""
-                prev_text = ""
+                chat_gpt_bot.config["model"] = model
+                delta = StreamDelta()
                 conversation_id = session.conversation_id
                 parent_id = session.parent_id
                 logging.info(
                     f"[Session] ask open ai user {user_id}, model: {model}, sentence: {sentence}, "
                     + f"conversation_id: {conversation_id}, parent_id: {parent_id} "
                 )
-                async for data in credential.chat_gpt_bot.ask(
+                start_time = time.monotonic()
+                upstream_response.set(
+                    lambda: self.observe_stage("connect", model, credential.label, start_time)
+                )
+                first = True
+                async for data in chat_gpt_bot.ask(
                     sentence, conversation_id=conversation_id, parent_id=parent_id
                 ):
-                    message = data["message"][len(prev_text) :]
-                    res += message
-                    prev_text = data["message"]
+                    if first:
+                        credential.observe_latency(time.monotonic() - start_time)
+                        self.affinity.bind(data["conversation_id"], credential.email)
+                        self.observe_stage("ttft", model, credential.label, start_time)
+                        first_time = time.monotonic()
+                        first = False
+                    delta.feed(data["message"])
                     conversation_id = data["conversation_id"]
                     parent_id = data["parent_id"]
+                res = delta.text
                 if len(res) == 0:
                     raise Exception("empty response")
                 session.update(conversation_id=conversation_id, parent_id=parent_id)
+                self._save_session(model, user_id, session)
+                self.observe_stage("stream", model, credential.label, first_time)
+                credential.record_success()
                 return res
             except ChatGPTError as e:
-                credential.refresh_access_token()
-                self._clean_session(user_id)
                 logging.error(
                     "[Engine] chat gpt engine get chat gpt error: {}".format(e.message)
                 )
-                error_code = e.code
-                if error_code >= 500:
-                    e.code = ChatGPTErrorType.SERVER_ERROR
-                    e.message = "OpenAI Server Error"
-                elif error_code == 429:
-                    e.code = ChatGPTErrorType.RATE_LIMIT_ERROR
-                    e.message = "Too many requests, please retry later"
-                elif (
-                    error_code == ChatGPTErrorType.EXPIRED_ACCESS_TOKEN_ERROR
-                    or error_code == ChatGPTErrorType.INVALID_ACCESS_TOKEN_ERROR
-                ):
-                    e.message = "OpenAI Token Invalid, please retry"
-                else:
-                    e.code = ChatGPTErrorType.UNKNOWN_ERROR
-                    e.message = "Unknown Error"
+                self._classify_error(e)
+                credential.record_failure(
+                    rate_limited=e.code == ChatGPTErrorType.RATE_LIMIT_ERROR
+                )
+                credential.request_refresh()
+                self._clean_session(user_id)
                 raise e
             except HTTPStatusError as e:
+                credential.record_failure(rate_limited=e.response.status_code == 429)
                 if e.response.status_code == 429:
                     message = "😱 机器人负载过多，请稍后再试"
-                    raise ChatGPTError(source="chat_with_chatgpt", message=message)
+                    raise ChatGPTError(
+                        source="chat_with_chatgpt",
+                        message=message,
+                        code=ChatGPTErrorType.RATE_LIMIT_ERROR,
+                    )
                 elif e.response.status_code >= 500:
                     raise ChatGPTError(
-                        source="chat_with_chatgpt", message="OpenAI Server Error"
+                        source="chat_with_chatgpt",
+                        message="OpenAI Server Error",
+                        code=ChatGPTErrorType.SERVER_ERROR,
                     )
             except Exception as e:
-                credential.refresh_access_token()
+                credential.record_failure()
+                credential.request_refresh()
                 self._clean_session(user_id)
                 logging.error("ChatGPTBot error: {}".format(e))
                 raise e
 
-    async def chat_stream_with_chatgpt(
-        self, sentence: str, user_id=None, model="text-davinci-002-render-sha"
+    async def _chat_stream_with_chatgpt(
+        self, sentence: str, user_id=None, model="text-davinci-002-render-sha", tried=None
     ) -> AsyncGenerator[str, None]:
+        tried = [] if tried is None else tried
         session = self._get_session_from_model_and_id(user_id, model)
-        credential = self._get_credential_from_session(session)
-        credential.chat_gpt_bot.conversation_id = None
-
-        if credential.lock is None:
-            credential.lock = asyncio.Lock()
+        credential = self._get_credential_from_session(session, tried)
+        self._check_credential_health(credential)
+        self._check_credential_quota(credential)
+        tried.append(credential)
 
-        async with credential.lock:
+        slot_start = time.monotonic()
+        async with credential.acquire() as chat_gpt_bot:
+            self.observe_stage("slot", model, credential.label, slot_start)
             try:
-                if model is not None:
-                    credential.chat_gpt_bot.config["model"] = model
-                else:
-                    credential.chat_gpt_bot.config["model"] = None
-                prev_text = ""
+                chat_gpt_bot.config["model"] = model
+                delta = StreamDelta()
                 conversation_id = session.conversation_id
                 parent_id = session.parent_id
                 logging.info(
                     f"[Session] ask open ai user {user_id}, model: {model}, sentence: {sentence}, "
                     + f"conversation_id: {conversation_id}, parent_id: {parent_id} "
                 )
-                async for data in credential.chat_gpt_bot.ask(
+                start_time = time.monotonic()
+                upstream_response.set(
+                    lambda: self.observe_stage("connect", model, credential.label, start_time)
+                )
+                first = True
+                upstream = chat_gpt_bot.ask(
                     sentence, conversation_id=conversation_id, parent_id=parent_id
-                ):
-                    message = data["message"][len(prev_text) :]
-                    prev_text = data["message"]
-                    conversation_id = data["conversation_id"]
-                    parent_id = data["parent_id"]
-                    session.update(conversation_id=conversation_id, parent_id=parent_id)
-                    yield message
+                )
+                try:
+                    async for data in upstream:
+                        started = first
+                        if first:
+                            credential.observe_latency(time.monotonic() - start_time)
+                            self.affinity.bind(data["conversation_id"], credential.email)
+                            self.observe_stage("ttft", model, credential.label, start_time)
+                            first_time = time.monotonic()
+                            first = False
+                        message = delta.feed(data["message"])
+                        conversation_id = data["conversation_id"]
+                        parent_id = data["parent_id"]
+                        session.update(
+                            conversation_id=conversation_id, parent_id=parent_id
+                        )
+                        # the conversation is saved once it exists and where it
+                        # ended, not for every token in between
+                        if started:
+                            self._save_session(model, user_id, session)
+                        if len(message) != 0:
+                            yield message
+                finally:
+                    # close the upstream response before the slot is released
+                    await upstream.aclose()
+                    if not first:
+                        self._save_session(model, user_id, session)
+                if not first:
+                    self.observe_stage("stream", model, credential.label, first_time)
+                credential.record_success()
+                if delta.rewrites > 0:
+                    logging.warning(
+                        "[Session] upstream rewrote streamed text {} times, user {}".format(
+                            delta.rewrites, user_id
+                        )
+                    )
 
             except ChatGPTError as e:
-                credential.refresh_access_token()
-                self._clean_session(user_id)
                 logging.error(
                     "[Engine] chat gpt engine get chat gpt error: {}".format(e.message)
                 )
-                error_code = e.code
-                if error_code >= 500:
-                    e.code = ChatGPTErrorType.SERVER_ERROR
-                    e.message = "OpenAI Server Error"
-                elif error_code == 429:
-                    e.code = ChatGPTErrorType.RATE_LIMIT_ERROR
-                    e.message = "Too many requests, please retry later"
-                elif (
-                    error_code == ChatGPTErrorType.EXPIRED_ACCESS_TOKEN_ERROR
-                    or error_code == ChatGPTErrorType.INVALID_ACCESS_TOKEN_ERROR
-                ):
-                    e.message = "OpenAI Token Invalid, please retry"
-                else:
-                    e.code = ChatGPTErrorType.UNKNOWN_ERROR
-                    e.message = "Unknown Error"
+                self._classify_error(e)
+                credential.record_failure(
+                    rate_limited=e.code == ChatGPTErrorType.RATE_LIMIT_ERROR
+                )
+                credential.request_refresh()
+                self._clean_session(user_id)
                 raise e
             except HTTPStatusError as e:
+                credential.record_failure(rate_limited=e.response.status_code == 429)
                 if e.response.status_code == 429:
                     message = "😱 机器人负载过多，请稍后再试(The robot is overwhelmed, please try again later)"
-                    raise ChatGPTError(source="chat_with_chatgpt", message=message)
+                    raise ChatGPTError(
+                        source="chat_with_chatgpt",
+                        message=message,
+                        code=ChatGPTErrorType.RATE_LIMIT_ERROR,
+                    )
                 elif e.response.status_code >= 500:
                     raise ChatGPTError(
-                        source="chat_with_chatgpt", message="OpenAI Server Error"
+                        source="chat_with_chatgpt",
+                        message="OpenAI Server Error",
+                        code=ChatGPTErrorType.SERVER_ERROR,
                     )
             except Exception as e:
                 logging.error("ChatGPTBot error: {}".format(e))
-                credential.refresh_token()
+                credential.record_failure()
+                credential.request_refresh()
                 self._clean_session(user_id)
                 raise e
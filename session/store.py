@@ -0,0 +1,118 @@
+import asyncio
+import logging
+import time
+from collections import OrderedDict
+from typing import Optional
+
+from .user_session import UserSession
+
+
+class SessionStore:
+    """
+    Bounded LRU store of user sessions keyed by (model, user_id).
+
+    Sessions idle for longer than ``ttl`` seconds, judged by
+    ``UserSession.last_time``, are dropped on access and by the background
+    sweeper; the least recently used session is evicted once ``max_size``
+    is reached.
+    """
+
+    def __init__(self, max_size=10000, ttl=86400, sweep_interval=60):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.sweep_interval = sweep_interval
+        self.sessions: "OrderedDict[tuple, UserSession]" = OrderedDict()
+        self.sweeper = None
+        self.hits = 0
+        self.misses = 0
+        self.evicted_lru = 0
+        self.evicted_ttl = 0
+        self.removed = 0
+
+    @staticmethod
+    def from_config(config) -> "SessionStore":
+        store_config = config["engine"].get("session", {}) or {}
+        return SessionStore(
+            max_size=store_config.get("maxSize", 10000),
+            ttl=store_config.get("ttl", 86400),
+            sweep_interval=store_config.get("sweepInterval", 60),
+        )
+
+    def __len__(self):
+        return len(self.sessions)
+
+    def _expired(self, session: UserSession, now):
+        return now - session.last_time > self.ttl
+
+    def get(self, model, user_id) -> Optional[UserSession]:
+        key = (model, user_id)
+        session = self.sessions.get(key)
+        if session is None:
+            self.misses += 1
+            return None
+        if self._expired(session, time.time()):
+            del self.sessions[key]
+            self.evicted_ttl += 1
+            self.misses += 1
+            return None
+        self.sessions.move_to_end(key)
+        self.hits += 1
+        return session
+
+    def put(self, model, user_id, session: UserSession):
+        key = (model, user_id)
+        self.sessions[key] = session
+        self.sessions.move_to_end(key)
+        while len(self.sessions) > self.max_size:
+            self.sessions.popitem(last=False)
+            self.evicted_lru += 1
+
+    def remove(self, model, user_id):
+        if self.sessions.pop((model, user_id), None) is not None:
+            self.removed += 1
+
+    def sweep(self):
+        # the front of the dict is the least recently used end, stop at the
+        # first session that is still fresh instead of scanning everything
+        now = time.time()
+        evicted = 0
+        while self.sessions:
+            key, session = next(iter(self.sessions.items()))
+            if not self._expired(session, now):
+                break
+            del self.sessions[key]
+            evicted += 1
+        self.evicted_ttl += evicted
+        return evicted
+
+    async def _sweep_forever(self):
+        while True:
+            await asyncio.sleep(self.sweep_interval)
+            evicted = self.sweep()
+            if evicted > 0:
+                logging.info(
+                    "[SessionStore] evicted {} idle sessions, size: {}".format(
+                        evicted, len(self.sessions)
+                    )
+                )
+
+    def start(self):
+        if self.sweeper is None:
+            self.sweeper = asyncio.create_task(self._sweep_forever())
+
+    def stop(self):
+        if self.sweeper is not None:
+            self.sweeper.cancel()
+            self.sweeper = None
+
+    def stats(self):
+        return {
+            "size": len(self.sessions),
+            "max_size": self.max_size,
+            "ttl": self.ttl,
+            "hits": self.hits,
+            "misses": self.misses,
+            "evicted_lru": self.evicted_lru,
+            "evicted_ttl": self.evicted_ttl,
+            "removed": self.removed,
+        }
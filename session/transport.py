@@ -0,0 +1,157 @@
+import asyncio
+import logging
+import time
+
+import httpx
+
+try:
+    import h2  # noqa: F401
+except ImportError:
+    h2 = None
+
+HANDSHAKE_EVENTS = ("connection.connect_tcp", "connection.connect_unix_socket", "connection.start_tls")
+# an http/1.1 connection is only reused once its response was read to the end
+DRAIN_TIMEOUT = 0.05
+DRAIN_MAX_BYTES = 64 * 1024
+
+
+class DrainingStream(httpx.AsyncByteStream):
+    """
+    Response body that reads a short unread tail before it is closed.
+
+    Clients stop reading a stream at the ``[DONE]`` event, just before the end
+    of the chunked body, and httpx closes such a connection instead of putting
+    it back to the pool.
+    """
+
+    def __init__(self, stream: httpx.AsyncByteStream):
+        self.stream = stream
+        self.iterator = None
+        self.consumed = False
+
+    async def __aiter__(self):
+        self.iterator = self.stream.__aiter__()
+        async for chunk in self.iterator:
+            yield chunk
+        self.consumed = True
+
+    async def _drain(self):
+        drained = 0
+        async for chunk in self.iterator:
+            drained += len(chunk)
+            if drained > DRAIN_MAX_BYTES:
+                return
+
+    async def aclose(self):
+        if self.iterator is not None and not self.consumed:
+            try:
+                await asyncio.wait_for(self._drain(), DRAIN_TIMEOUT)
+            except Exception as _:
+                pass
+        await self.stream.aclose()
+
+
+class ReusingTransport(httpx.AsyncBaseTransport):
+    def __init__(self, transport: httpx.AsyncBaseTransport):
+        self.transport = transport
+
+    async def handle_async_request(self, request: httpx.Request) -> httpx.Response:
+        response = await self.transport.handle_async_request(request)
+        response.stream = DrainingStream(response.stream)
+        return response
+
+    async def aclose(self):
+        await self.transport.aclose()
+
+
+class SharedTransport:
+    """
+    One upstream connection pool used by the clients of every account.
+
+    Each account keeps its own client, and so its own auth headers, on top
+    of the shared transport, so warm keep-alive and TLS connections survive a
+    token refresh and are reused across accounts. Connections and handshake
+    time are counted from the trace events of the transport to report how
+    often a request reused a connection.
+    """
+
+    def __init__(self, http2=True, max_connections=100, max_keepalive=20, keepalive_expiry=60):
+        if http2 and h2 is None:
+            logging.warning("[Transport] h2 is not installed, falling back to http/1.1")
+            http2 = False
+        self.http2 = http2
+        self.transport = ReusingTransport(httpx.AsyncHTTPTransport(
+            http2=http2,
+            limits=httpx.Limits(
+                max_connections=max_connections,
+                max_keepalive_connections=max_keepalive,
+                keepalive_expiry=keepalive_expiry,
+            ),
+        ))
+        self.plain_client = None
+        self.requests = 0
+        self.connections = 0
+        self.handshake_seconds = 0.0
+        self.http2_responses = 0
+
+    @staticmethod
+    def from_config(config) -> "SharedTransport":
+        transport_config = config["engine"]["chatgpt"].get("transport", {}) or {}
+        return SharedTransport(
+            http2=transport_config.get("http2", True),
+            max_connections=transport_config.get("maxConnections", 100),
+            max_keepalive=transport_config.get("maxKeepalive", 20),
+            keepalive_expiry=transport_config.get("keepaliveExpiry", 60),
+        )
+
+    def client(self, headers=None) -> httpx.AsyncClient:
+        # closing a client would close the shared transport, clients are never closed
+        return httpx.AsyncClient(
+            transport=self.transport,
+            headers=headers,
+            event_hooks={"request": [self._on_request], "response": [self._on_response]},
+        )
+
+    def shared_client(self) -> httpx.AsyncClient:
+        """A client without account headers, e.g. for token refreshes."""
+        if self.plain_client is None:
+            self.plain_client = self.client()
+        return self.plain_client
+
+    async def _on_request(self, request: httpx.Request):
+        self.requests += 1
+        started = {}
+
+        async def trace(event, _):
+            name, _, stage = event.rpartition(".")
+            if name not in HANDSHAKE_EVENTS:
+                return
+            if stage == "started":
+                started[name] = time.monotonic()
+            elif stage == "complete" and name in started:
+                self.handshake_seconds += time.monotonic() - started.pop(name)
+                if name != "connection.start_tls":
+                    self.connections += 1
+
+        request.extensions["trace"] = trace
+
+    async def _on_response(self, response: httpx.Response):
+        if response.http_version == "HTTP/2":
+            self.http2_responses += 1
+
+    async def aclose(self):
+        await self.transport.aclose()
+
+    def snapshot(self):
+        reused = max(self.requests - self.connections, 0)
+        handshake = self.handshake_seconds / self.connections if self.connections else None
+        return {
+            "http2": self.http2,
+            "requests": self.requests,
+            "connections": self.connections,
+            "http2_responses": self.http2_responses,
+            "reuse_rate": reused / self.requests if self.requests else 0,
+            "handshake_seconds": handshake,
+            # every reused connection skipped one average handshake
+            "handshake_seconds_saved": reused * handshake if handshake is not None else 0,
+        }
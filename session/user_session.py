@@ -3,6 +3,7 @@ from .credential import Credential
 
 
 class UserSession:
+    __slots__ = ("user_id", "conversation_id", "parent_id", "last_time", "credential")
 
     def __init__(self, user_id, conversation_id=None, parent_id=None, credential: Credential = None):
         self.user_id = user_id
@@ -11,8 +12,11 @@ class UserSession:
         self.last_time = time.time()
         self.credential = credential
 
-
     def update(self, parent_id=None, conversation_id=None):
         self.last_time = time.time()
         self.parent_id = parent_id
         self.conversation_id = conversation_id or self.conversation_id
+
+    def row(self, model):
+        email = self.credential.email if self.credential is not None else None
+        return (model, self.user_id, self.conversation_id, self.parent_id, email, self.last_time)
@@ -20,9 +20,10 @@ def get_config_path():
         return args.config
 
 
-def load_config():
+def load_config(config_path=None):
     try:
-        config_path = get_config_path()
+        if config_path is None:
+            config_path = get_config_path()
         return load_yaml(config_path)
 
     except Exception as e: